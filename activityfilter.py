@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Statshunters activity filters
+
+A filter is a python expression over the fields of an activity (name, date, type, distance...),
+for example `type=="Ride" and date>="2021"`. Only comparisons, `in` and boolean logic of fields
+and constants are allowed: the expression is never given to eval. It is compiled once into a
+predicate evaluated on all the activities at once, with a column (numpy array) per field.
+"""
+
+import ast
+import operator
+from functools import lru_cache, partial, reduce
+
+import numpy as np
+
+# Compiled filters kept, by filter string
+FILTER_CACHE_SIZE = 128
+
+COMPARISONS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+               ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+
+class FilterError(ValueError):
+    """Filter string not valid, or not applicable to the activities"""
+
+
+def _constant(node):
+    """Value of a constant node (string, number or boolean), None if it isn't one"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool)):
+        return node
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) \
+            and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float)):
+        return ast.Constant(-node.operand.value if isinstance(node.op, ast.USub) else node.operand.value)
+    return None
+
+
+def _is_str(value):
+    return isinstance(value, str) or (isinstance(value, np.ndarray) and value.dtype.kind == 'U')
+
+
+def _truth(value):
+    """Truth value of a field or constant, as for python values (missing values are false)"""
+    if not isinstance(value, np.ndarray):
+        return bool(value)
+    if value.dtype.kind == 'U':
+        return value != ''
+    if value.dtype.kind == 'b':
+        return value
+    return (value != 0) & ~np.isnan(value)
+
+
+def _contains(item, container):
+    """item in container, with container a field, a constant string or a tuple of constants"""
+    if isinstance(container, tuple):
+        if isinstance(item, np.ndarray):
+            return np.isin(item, [value for value in container if _is_str(value) == _is_str(item)])
+        return item in container
+    if not _is_str(item) or not _is_str(container):
+        raise FilterError("'in' needs strings, or a list of values")
+    if isinstance(container, np.ndarray):
+        if isinstance(item, np.ndarray):
+            return np.array([i in c for i, c in zip(item, container)], dtype=bool)
+        return np.char.find(container, item) >= 0
+    if isinstance(item, np.ndarray):
+        return np.array([i in container for i in item], dtype=bool)
+    return item in container
+
+
+def _compare(op, left, right):
+    if _is_str(left) != _is_str(right):
+        # As in python, a string is never equal to a number, and can't be ordered with it
+        if op is operator.eq or op is operator.ne:
+            return op is operator.ne
+        raise FilterError("A text field can't be compared to a number")
+    return op(left, right)
+
+
+class ActivityFilter(object):
+    """Predicate of a filter string, called with an ActivityTable it returns the activities selected"""
+
+    def __init__(self, filter_str):
+        self.filter_str = filter_str
+        try:
+            tree = ast.parse(filter_str.strip(), mode='eval')
+        except SyntaxError as e:
+            raise FilterError("Filter syntax error: {}".format(e.msg))
+        self.fields = set()
+        self._predicate = self._compile(tree.body)
+
+    def __call__(self, table):
+        """Boolean array of the activities of the table selected by the filter"""
+        if not len(table):
+            # Without activities there are no known fields, and nothing to select
+            return np.zeros(0, dtype=bool)
+        for field in self.fields:
+            if field not in table.fields:
+                raise FilterError("Unknown activity field: {}".format(field))
+        selected = _truth(self._predicate(table))
+        return np.broadcast_to(selected, (len(table),))
+
+    def _compile(self, node):
+        """Function of an ActivityTable computing the value of node: a column or a constant"""
+        constant = _constant(node)
+        if constant is not None:
+            value = constant.value
+            return lambda table: value
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            values = [_constant(element) for element in node.elts]
+            if None in values:
+                raise FilterError("Lists can only hold constants")
+            values = tuple(value.value for value in values)
+            return lambda table: values
+        if isinstance(node, ast.Name):
+            name = node.id
+            self.fields.add(name)
+            return lambda table: table.column(name)
+        if isinstance(node, ast.BoolOp):
+            values = [self._compile(value) for value in node.values]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return lambda table: reduce(combine, (_truth(value(table)) for value in values))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = self._compile(node.operand)
+            return lambda table: np.logical_not(_truth(operand(table)))
+        if isinstance(node, ast.Compare):
+            return self._compile_compare(node)
+        raise FilterError("Not allowed in a filter: {}".format(ast.get_source_segment(self.filter_str.strip(), node)
+                                                               or type(node).__name__))
+
+    def _compile_compare(self, node):
+        operands = [self._compile(node.left)] + [self._compile(comparator) for comparator in node.comparators]
+        tests = []
+        for i, op in enumerate(node.ops):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                test = _contains
+                if isinstance(op, ast.NotIn):
+                    test = lambda left, right: np.logical_not(_contains(left, right))
+            elif type(op) in COMPARISONS:
+                test = partial(_compare, COMPARISONS[type(op)])
+            else:
+                raise FilterError("Not allowed in a filter: {}".format(type(op).__name__))
+            tests.append((test, operands[i], operands[i + 1]))
+
+        # Chained comparisons, as a < b < c, are the and of each comparison
+        return lambda table: reduce(np.logical_and, (test(left(table), right(table)) for test, left, right in tests))
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def compile_filter(filter_str):
+    """ActivityFilter of a filter string, compiled once"""
+    return ActivityFilter(filter_str)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from compiledtile import source_version
+
+# Change it when the content or the layout of the index files change
+FORMAT_VERSION = 1
+MAGIC = b"RTACTIDX"
+INDEX_FILE = "activities.idx"
+
+# Arrays of an index file, in their order in the file
+ARRAYS = (("tile_offsets", np.int64), ("tile_x", np.int32), ("tile_y", np.int32),
+          ("visited_x", np.int32), ("visited_y", np.int32))
+
+# Last index of each activities folder, by folder
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _unique_tiles(x, y):
+    """Tiles (x, y) without duplicates"""
+    keys = np.unique((x.astype(np.int64) << 32) | y.astype(np.int64))
+    return (keys >> 32).astype(np.int32), (keys & 0xffffffff).astype(np.int32)
+
+
+def activity_pages(activities_dir):
+    """Versions of the activities pages (json files) of a statshunters folder, by file name"""
+    return {entry.name: source_version(entry.path) for entry in os.scandir(activities_dir)
+            if entry.name.endswith(".json")}
+
+
+class ActivityTable(object):
+    """Fields of activities as columns: numpy arrays of numbers (nan if missing) or of strings ('' if missing),
+    built at their first use"""
+
+    def __init__(self, activities):
+        self.activities = activities
+        self.fields = set().union(*activities)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.activities)
+
+    def column(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            values = [activity.get(name) for activity in self.activities]
+            if all(isinstance(value, (int, float)) for value in values if value is not None):
+                column = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+            else:
+                column = np.array(['' if value is None else str(value) for value in values], dtype=str)
+            self._columns[name] = column
+        return column
+
+
+class ActivityIndex(object):
+    """Activities of a statshunters folder, without their JSON pages
+
+    The fields of each activity (without its tiles) and its tiles, as one array of all the tiles
+    (tile_x, tile_y) with the start of the tiles of each activity (tile_offsets), plus the tiles
+    visited by all the activities. Activities are grouped by page, so that only the pages
+    downloaded again are parsed to update it.
+    """
+
+    def __init__(self):
+        # [file name, version, first activity, activities count]
+        self.pages = []
+        self.activities = []
+        self.tile_offsets = np.zeros(1, dtype=np.int64)
+        self.tile_x = np.zeros(0, dtype=np.int32)
+        self.tile_y = np.zeros(0, dtype=np.int32)
+        self.visited_x = np.zeros(0, dtype=np.int32)
+        self.visited_y = np.zeros(0, dtype=np.int32)
+        self._table = None
+
+    @property
+    def table(self):
+        """ActivityTable of the activities"""
+        if self._table is None:
+            self._table = ActivityTable(self.activities)
+        return self._table
+
+    def page_versions(self):
+        return {name: version for name, version, _, _ in self.pages}
+
+    def activity_tiles(self):
+        """Index of the activity of each tile of tile_x, tile_y"""
+        return np.repeat(np.arange(len(self.activities)), np.diff(self.tile_offsets))
+
+    def tiles(self, selected=None):
+        """Tiles "x_y" of the activities selected (boolean array), of all of them if None"""
+        if selected is None:
+            x, y = self.visited_x, self.visited_y
+        else:
+            mask = np.asarray(selected, dtype=bool)[self.activity_tiles()]
+            x, y = _unique_tiles(self.tile_x[mask], self.tile_y[mask])
+        return frozenset("{}_{}".format(*tile) for tile in zip(x.tolist(), y.tolist()))
+
+    def updated(self, activities_dir, pages=None):
+        """Index of the folder, with the pages added or changed since this one parsed"""
+        if pages is None:
+            pages = activity_pages(activities_dir)
+        indexed = {page[0]: page for page in self.pages}
+        index = ActivityIndex()
+        counts = []
+        tiles_x = []
+        tiles_y = []
+        for name in sorted(pages):
+            page = indexed.get(name)
+            if page is not None and page[1] == pages[name]:
+                # Activities already indexed, from the same page version
+                _, _, first, count = page
+                activities = self.activities[first:first + count]
+                start, end = self.tile_offsets[first], self.tile_offsets[first + count]
+                page_counts = np.diff(self.tile_offsets[first:first + count + 1])
+                page_x = self.tile_x[start:end]
+                page_y = self.tile_y[start:end]
+            else:
+                try:
+                    with open(os.path.join(activities_dir, name)) as f:
+                        d = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                activities = []
+                page_counts = []
+                page_tiles = []
+                for activity in d.get('activities', []):
+                    tiles = activity.get('tiles', [])
+                    # Scalar fields are kept for the filters
+                    activities.append({key: value for key, value in activity.items()
+                                       if isinstance(value, (str, int, float, bool)) or value is None})
+                    page_counts.append(len(tiles))
+                    page_tiles.extend((tile['x'], tile['y']) for tile in tiles)
+                page_tiles = np.array(page_tiles, dtype=np.int32).reshape(-1, 2)
+                page_x = page_tiles[:, 0]
+                page_y = page_tiles[:, 1]
+            index.pages.append([name, pages[name], len(index.activities), len(activities)])
+            index.activities.extend(activities)
+            counts.append(np.asarray(page_counts, dtype=np.int64))
+            tiles_x.append(page_x)
+            tiles_y.append(page_y)
+        if counts:
+            index.tile_offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype(np.int64)
+            index.tile_x = np.concatenate(tiles_x).astype(np.int32)
+            index.tile_y = np.concatenate(tiles_y).astype(np.int32)
+        index.visited_x, index.visited_y = _unique_tiles(index.tile_x, index.tile_y)
+        return index
+
+    def save(self, filename):
+        header = json.dumps({"format": FORMAT_VERSION, "pages": self.pages, "activities": self.activities,
+                             "tiles": len(self.tile_x), "visited": len(self.visited_x)}).encode()
+        tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, "wb") as hf:
+            hf.write(MAGIC)
+            hf.write(struct.pack("<Q", len(header)))
+            hf.write(header)
+            for name, dtype in ARRAYS:
+                hf.write(b"\0" * (_align(hf.tell()) - hf.tell()))
+                hf.write(np.asarray(getattr(self, name), dtype=dtype).tobytes())
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Read an index file, None if it is missing, broken or of another format"""
+        try:
+            with open(filename, "rb") as hf:
+                data = mmap.mmap(hf.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                return None
+            header_length, = struct.unpack_from("<Q", data, len(MAGIC))
+            offset = len(MAGIC) + 8
+            header = json.loads(data[offset:offset + header_length])
+            if header.get("format") != FORMAT_VERSION:
+                return None
+            offset += header_length
+
+            index = cls()
+            index.pages = header["pages"]
+            index.activities = header["activities"]
+            counts = {"tile_offsets": len(index.activities) + 1, "tile_x": header["tiles"], "tile_y": header["tiles"],
+                      "visited_x": header["visited"], "visited_y": header["visited"]}
+            for name, dtype in ARRAYS:
+                offset = _align(offset)
+                setattr(index, name, np.frombuffer(data, dtype=dtype, count=counts[name], offset=offset))
+                offset += counts[name] * np.dtype(dtype).itemsize
+            return index
+        except (struct.error, ValueError, KeyError):
+            return None
+
+
+def activity_index(activities_dir):
+    """Up to date ActivityIndex of a statshunters folder
+
+    It is kept in memory and in the INDEX_FILE of the folder, only the pages added or changed
+    since it was saved are parsed."""
+    activities_dir = str(activities_dir)
+    pages = activity_pages(activities_dir)
+    with _indexes_lock:
+        index = _indexes.get(activities_dir)
+        if index is not None and index.page_versions() == pages:
+            return index
+
+        filename = os.path.join(activities_dir, INDEX_FILE)
+        if index is None:
+            index = ActivityIndex.load(filename) or ActivityIndex()
+        if index.page_versions() != pages:
+            index = index.updated(activities_dir, pages)
+            try:
+                index.save(filename)
+            except OSError:
+                pass
+        _indexes[activities_dir] = index
+        return index
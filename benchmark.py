@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks for route-tiles, run on a saved OSM extract so that no download is involved"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+from pyroutelib3 import Datastore
+from tile import CoordDict
+from tilesrouter import MyRouter
+from utils import distance
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS isn't reported
+    resource = None
+
+
+def bench_route(args):
+    """Run one route search and report the expansions per second of the main search"""
+    # MyRouter exports its debug files relative to the working directory
+    Path('debug').mkdir(exist_ok=True)
+    with redirect_stdout(StringIO()):
+        router = Datastore(args.mode, localfile=args.osm)
+        coord_dict = CoordDict(router)
+        start = coord_dict.get(*args.start)
+        end = coord_dict.get(*args.end)
+        waypoints = [coord_dict.get(*wp) for wp in args.waypoint]
+
+    my_router = MyRouter(router, start, end, list(args.tiles), waypoints,
+                         {'turnaround_cost': args.turnaround_cost})
+    start_time = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        route = my_router.run()
+    elapsed = time.perf_counter() - start_time
+    print("{} expansions in {:.2f}s -> {:.0f} expansions/s, length {}".format(
+        my_router.expansions, elapsed, my_router.expansions / elapsed,
+        "{:.3f}km".format(route.length) if route else "-"))
+
+
+def bench_relax(args):
+    """Relaxations per second with the edge costs stored in the graph, and with the haversine of each edge"""
+    with redirect_stdout(StringIO()):
+        router = Datastore(args.mode, localfile=args.osm)
+    edges = [(node_a, node_b, cost) for node_a, nodes in router.routing.items() for node_b, cost in nodes.items()]
+
+    # Sum of the costs of the relaxed edges, printed so that both loops do the same work
+    total_cost = 0.0
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        for node_a, node_b, cost in edges:
+            total_cost += cost
+    elapsed = time.perf_counter() - start_time
+    print("stored cost: {:.0f} relaxations/s (total cost {:.1f})".format(
+        len(edges) * args.repeat / elapsed, total_cost))
+
+    total_cost = 0.0
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        for node_a, node_b, cost in edges:
+            total_cost += distance(router.rnodes[node_a], router.rnodes[node_b]) / 0.9
+    elapsed = time.perf_counter() - start_time
+    print("haversine  : {:.0f} relaxations/s (total cost {:.1f})".format(
+        len(edges) * args.repeat / elapsed, total_cost))
+
+
+def _peak_rss():
+    """Peak resident memory of the process in MB, None if unknown"""
+    if resource is None:
+        return None
+    # In kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_parse(args):
+    """Parse time and peak memory of an OSM file (a dense urban tile is the worst case)"""
+    with redirect_stdout(StringIO()):
+        router = Datastore(args.mode)
+    start_rss = _peak_rss()
+
+    elapsed = []
+    for _ in range(args.repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        compiled = router.compile_osm(args.osm)
+        elapsed.append(time.perf_counter() - start_time)
+    print("{} nodes, {} edges, {} restrictions, parsed in {:.2f}s (best of {})".format(
+        len(compiled.node_ids), len(compiled.edge_src), len(compiled.restrictions), min(elapsed), args.repeat))
+    if start_rss is not None:
+        print("peak RSS {:.1f}MB (before parsing {:.1f}MB)".format(_peak_rss(), start_rss))
+
+    del compiled
+    gc.collect()
+    tracemalloc.start()
+    router.compile_osm(args.osm)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("python allocations peak {:.1f}MB".format(peak / 1e6))
+
+
+def bench_memory(args):
+    """Load N zoom-15 tiles of the tiles cache with both graph backends and compare their memory"""
+    files = sorted(Path(args.cache_dir).glob('15/*/*/data.osm'))[:args.n]
+    print("{} tiles from {}".format(len(files), args.cache_dir))
+    for compact_graph in (False, True):
+        gc.collect()
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            router = Datastore(args.mode, compact_graph=compact_graph)
+            for file in files:
+                router.load_osm(file)
+            if compact_graph:
+                router.graph.compact()
+        elapsed = time.perf_counter() - start_time
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{:8}: {} nodes, {} routing nodes, {:.1f}MB (peak {:.1f}MB), loaded in {:.2f}s".format(
+            "compact" if compact_graph else "dict", len(router.rnodes), len(router.routing),
+            current / 1e6, peak / 1e6, elapsed))
+        del router
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Route Tiles benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_route = subparsers.add_parser('route', help="Expansions per second of the route search")
+    parser_route.add_argument('--osm', required=True, help="Saved OSM file to route on")
+    parser_route.add_argument('--mode', default='roadcycle', help="Transport mode")
+    parser_route.add_argument('--start', nargs=2, type=float, required=True, metavar=('LAT', 'LON'))
+    parser_route.add_argument('--end', nargs=2, type=float, required=True, metavar=('LAT', 'LON'))
+    parser_route.add_argument('--tiles', nargs='*', default=[], help="Tiles to visit (x_y, zoom 14)")
+    parser_route.add_argument('--waypoint', nargs=2, type=float, action='append', default=[],
+                              metavar=('LAT', 'LON'))
+    parser_route.add_argument('--turnaround-cost', type=float, default=0.0)
+    parser_route.set_defaults(func=bench_route)
+
+    parser_relax = subparsers.add_parser('relax', help="Edge relaxations per second")
+    parser_relax.add_argument('--osm', required=True, help="Saved OSM file")
+    parser_relax.add_argument('--mode', default='roadcycle', help="Transport mode")
+    parser_relax.add_argument('--repeat', type=int, default=10)
+    parser_relax.set_defaults(func=bench_relax)
+
+    parser_parse = subparsers.add_parser('parse', help="Parse time and peak memory of an OSM file")
+    parser_parse.add_argument('--osm', required=True, help="Saved OSM file, for example a dense urban tile")
+    parser_parse.add_argument('--mode', default='roadcycle', help="Transport mode")
+    parser_parse.add_argument('--repeat', type=int, default=3)
+    parser_parse.set_defaults(func=bench_parse)
+
+    parser_memory = subparsers.add_parser('memory', help="Memory of the graph backends")
+    parser_memory.add_argument('--cache-dir', default=str(Path.home().joinpath('.tilescache')),
+                               help="Tiles cache to load the tiles from")
+    parser_memory.add_argument('-n', type=int, default=50, help="Number of tiles to load")
+    parser_memory.add_argument('--mode', default='roadcycle', help="Transport mode")
+    parser_memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Check of the statshunters pages download, against a local stand-in of statshunters
+
+The stand-in serves activities pages with an ETag (a Last-Modified date only for some of them),
+answers 304 to the conditional requests of the pages that haven't changed, and an empty page
+after the last one. The download must only rewrite the pages changed, keep the pages answered
+by a 304, and stop at the empty page."""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import tempfile
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from statshunters import PAGES_META, PagesDownloader
+
+ACTIVITIES_PER_PAGE = 20
+# Date of the pages served, changed pages are one day later
+PAGES_DATE = 1600000000
+
+
+def activities_page(page, activities, version=0):
+    """JSON content of an activities page"""
+    return json.dumps({"activities": [
+        {"name": "Activity {}.{}".format(page, i), "type": "Ride", "distance": 1000.0 * (i + version),
+         "tiles": [{"x": 8250 + page, "y": 5600 + i}]} for i in range(activities)]}).encode()
+
+
+class StatshuntersStandIn(ThreadingHTTPServer):
+    """Statshunters activities pages of a sharelink, the pages after the last ones are empty
+
+    Pages listed in without_etag are served with a Last-Modified date only. Requests are logged
+    as (page, status)."""
+    daemon_threads = True
+
+    def __init__(self, pages, without_etag=()):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.pages = {}
+        self.dates = {}
+        self.without_etag = set(without_etag)
+        self.requests = []
+        self.lock = threading.Lock()
+        for page, content in pages.items():
+            self.set_page(page, content)
+
+    @property
+    def sharelink_url(self):
+        return "http://127.0.0.1:{}/share/standin".format(self.server_address[1])
+
+    def set_page(self, page, content, date=PAGES_DATE):
+        self.pages[page] = content
+        self.dates[page] = date
+
+    def remove_pages(self, first_page):
+        """Pages from first_page are empty, as from now"""
+        date = max(self.dates.values()) + 86400
+        for page in [page for page in self.pages if page >= first_page]:
+            del self.pages[page]
+            self.dates[page] = date
+
+    def statuses(self):
+        """Status of the requests of each page since the last call"""
+        with self.lock:
+            requests, self.requests = self.requests, []
+        statuses = {}
+        for page, status in requests:
+            statuses.setdefault(page, []).append(status)
+        return statuses
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        if parts.path != urlsplit(server.sharelink_url).path + "/api/activities":
+            self._send(404, b"")
+            return
+        page = int(parse_qs(parts.query)['page'][0])
+        content = server.pages.get(page, activities_page(page, 0))
+        date = server.dates.get(page, PAGES_DATE)
+        headers = {'Last-Modified': formatdate(date, usegmt=True)}
+        if page not in server.without_etag:
+            headers['ETag'] = '"{}"'.format(hashlib.md5(content).hexdigest())
+
+        if 'ETag' in headers and self.headers.get('If-None-Match'):
+            not_modified = self.headers['If-None-Match'] == headers['ETag']
+        elif self.headers.get('If-Modified-Since'):
+            not_modified = parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp() >= date
+        else:
+            not_modified = False
+        with server.lock:
+            server.requests.append((page, 304 if not_modified else 200))
+        if not_modified:
+            self._send(304, b"", headers)
+            return
+
+        headers['Content-Type'] = 'application/json'
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content)
+            headers['Content-Encoding'] = 'gzip'
+        self._send(200, content, headers)
+
+    def _send(self, status, content, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def page_files(activities_dir):
+    """Identity (inode, modification time) of the pages files, by page"""
+    files = {}
+    for filepath in Path(activities_dir).glob("activities_*.json"):
+        stat = filepath.stat()
+        files[int(filepath.stem.split('_')[-1])] = (stat.st_ino, stat.st_mtime_ns)
+    return files
+
+
+def download(server, activities_dir, threads):
+    """Download all the pages, return the status of the requests of each page"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        PagesDownloader(server.sharelink_url, activities_dir, threads).download()
+    return server.statuses()
+
+
+def check_pages(server, activities_dir, last_page):
+    """The pages files are the pages served, up to the empty page after last_page"""
+    for page in range(1, last_page + 2):
+        content = Path(activities_dir).joinpath("activities_{}.json".format(page)).read_bytes()
+        assert content == server.pages.get(page, activities_page(page, 0)), "page {} differs".format(page)
+    assert max(page_files(activities_dir)) == last_page + 1, "pages kept after the empty page"
+
+
+def check_requests(statuses, last_page, threads):
+    """Pages after the empty one are only asked by the threads which started before it was received"""
+    assert all(page in statuses for page in range(1, last_page + 2)), "pages not asked"
+    assert max(statuses) <= last_page + threads, "download not stopped at the empty page: page {} asked" \
+        .format(max(statuses))
+
+
+def run(pages, threads):
+    server = StatshuntersStandIn({page: activities_page(page, ACTIVITIES_PER_PAGE) for page in range(1, pages + 1)},
+                                 without_etag=[2])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as activities_dir:
+            statuses = download(server, activities_dir, threads)
+            check_requests(statuses, pages, threads)
+            check_pages(server, activities_dir, pages)
+            assert all(status == [200] for status in statuses.values()), "pages not downloaded: {}".format(statuses)
+            meta = json.loads(Path(activities_dir).joinpath(PAGES_META).read_text())
+            assert meta["1"]["etag"] and not meta["2"]["etag"] and meta["2"]["last_modified"], "meta not kept"
+            print("first download: {} pages, stopped at page {}".format(pages, pages + 1))
+
+            # Nothing changed: 304 for every page, files kept as they are
+            files = page_files(activities_dir)
+            statuses = download(server, activities_dir, threads)
+            check_requests(statuses, pages, threads)
+            assert all(statuses[page] == [304] for page in range(1, pages + 2)), \
+                "unchanged pages downloaded again: {}".format(statuses)
+            assert page_files(activities_dir) == files, "unchanged pages rewritten"
+            check_pages(server, activities_dir, pages)
+            print("download again: 304 for all pages, no page rewritten")
+
+            # Changed pages (one with an ETag, one with a date only) are the only ones rewritten
+            changed = [1, 2]
+            for page in changed:
+                server.set_page(page, activities_page(page, ACTIVITIES_PER_PAGE, version=1), PAGES_DATE + 86400)
+            statuses = download(server, activities_dir, threads)
+            check_requests(statuses, pages, threads)
+            assert all(statuses[page] == [200 if page in changed else 304] for page in range(1, pages + 2)), \
+                "wrong pages downloaded: {}".format(statuses)
+            new_files = page_files(activities_dir)
+            assert sorted(page for page in files if files[page] != new_files[page]) == changed, "wrong pages rewritten"
+            check_pages(server, activities_dir, pages)
+            print("pages {} changed: only them rewritten".format(changed))
+
+            # Activities removed: the pages after the new empty page are removed
+            last_page = pages // 2
+            server.remove_pages(last_page + 1)
+            statuses = download(server, activities_dir, threads)
+            check_requests(statuses, last_page, threads)
+            check_pages(server, activities_dir, last_page)
+            print("{} pages left: stopped at page {}, the next pages removed".format(last_page, last_page + 1))
+    finally:
+        server.shutdown()
+        server.server_close()
+    print("OK")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the statshunters pages download against a local stand-in')
+    parser.add_argument('--pages', type=int, default=12, help="Activities pages served (at least 2)")
+    parser.add_argument('--threads', type=int, default=4, help="Download threads")
+    args = parser.parse_args()
+    if args.pages < 2:
+        parser.error("--pages must be at least 2: pages 1 and 2 are changed by the check")
+    run(args.pages, args.threads)
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from array import array
+from collections.abc import MutableMapping
+
+import numpy as np
+
+# Edges changed since the last compaction are kept in dicts, until they are more than this
+# (or more than a quarter of the compacted edges)
+COMPACT_MIN_PENDING = 100000
+
+
+class CompactGraph(object):
+    """Routing graph stored in arrays instead of dicts of dicts
+
+    Node ids are remapped to dense indexes, with their lat/lon in two float arrays.
+    Edges are stored in CSR form (offsets/targets/weights arrays, in insertion order for each node).
+    Changes are first stored in a small pending layer, merged in the arrays by compact().
+
+    routing and rnodes are views with the same interface than the Datastore dicts.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.routable = bytearray()
+        self.index = {}
+
+        # offsets, targets, weights: replaced at once by compact(), for the threads reading the graph
+        self._csr = (np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64))
+        # source index -> {target index: weight, or None if the edge is removed}
+        self._pending = {}
+        self._pending_count = 0
+        self._routable_count = 0
+
+        self.routing = CompactRouting(self)
+        self.rnodes = CompactNodes(self)
+
+    def add_node(self, node_id, lat, lon):
+        i = self.index.get(node_id)
+        if i is None:
+            i = len(self.ids)
+            self.index[node_id] = i
+            self.ids.append(node_id)
+            self.lats.append(lat)
+            self.lons.append(lon)
+            self.routable.append(0)
+        else:
+            self.lats[i] = lat
+            self.lons[i] = lon
+        return i
+
+    def set_routable(self, i, routable=True):
+        if self.routable[i] != routable:
+            self.routable[i] = routable
+            self._routable_count += 1 if routable else -1
+
+    def edges(self, i):
+        """Return the {target index: weight} dict of the edges from node index i"""
+        # Pending edges are read first: compact() replaces them after the arrays. A pending dict
+        # is never changed, set_edge replaces it.
+        pending = self._pending.get(i)
+        offsets, targets, weights = self._csr
+        if i + 1 < len(offsets):
+            start, end = offsets[i], offsets[i + 1]
+            edges = dict(zip(targets[start:end].tolist(), weights[start:end].tolist()))
+        else:
+            edges = {}
+        if pending:
+            for target, weight in pending.items():
+                if weight is None:
+                    edges.pop(target, None)
+                else:
+                    edges[target] = weight
+        return edges
+
+    def weight(self, source, target):
+        """Weight of the edge source -> target (node indexes), None if there is no such edge"""
+        pending = self._pending.get(source)
+        if pending and target in pending:
+            return pending[target]
+        offsets, targets, weights = self._csr
+        if source + 1 < len(offsets):
+            # A few edges by node: a list search is faster than numpy on them
+            start, end = offsets[source:source + 2].tolist()
+            row = targets[start:end].tolist()
+            if target in row:
+                return float(weights[start + row.index(target)])
+        return None
+
+    def set_edge(self, source, target, weight):
+        """Add or update (or remove if weight is None) the edge source -> target (node indexes)"""
+        pending = dict(self._pending.get(source, ()))
+        if target not in pending:
+            self._pending_count += 1
+        pending[target] = weight
+        self._pending[source] = pending
+        if self._pending_count > max(COMPACT_MIN_PENDING, len(self._csr[1]) // 4):
+            self.compact()
+
+    def compact(self):
+        """Merge the pending edges in the CSR arrays"""
+        if not self._pending:
+            return
+        node_count = len(self.ids)
+        offsets, targets, weights = self._csr
+
+        pending_sources = array('q')
+        pending_targets = array('q')
+        pending_weights = array('d')
+        for source, edges in self._pending.items():
+            for target, weight in edges.items():
+                pending_sources.append(source)
+                pending_targets.append(target)
+                pending_weights.append(np.nan if weight is None else weight)
+
+        sources = np.concatenate((np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)),
+                                  np.frombuffer(pending_sources, dtype=np.int64)))
+        targets = np.concatenate((targets.astype(np.int64), np.frombuffer(pending_targets, dtype=np.int64)))
+        weights = np.concatenate((weights, np.frombuffer(pending_weights, dtype=np.float64)))
+        sequence = np.arange(len(sources))
+
+        # An edge updated by a pending one keeps its position but takes the new weight
+        order = np.lexsort((sequence, sources * node_count + targets))
+        keys = (sources * node_count + targets)[order]
+        firsts = order[np.r_[True, keys[1:] != keys[:-1]]]
+        lasts = order[np.r_[keys[1:] != keys[:-1], True]]
+        weights = weights[lasts]
+        kept = ~np.isnan(weights)
+        firsts, weights = firsts[kept], weights[kept]
+
+        order = np.lexsort((firsts, sources[firsts]))
+        offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources[firsts], minlength=node_count), out=offsets[1:])
+        self._csr = (offsets, targets[firsts][order].astype(np.int32), weights[order])
+
+        self._pending = {}
+        self._pending_count = 0
+
+
+class CompactAdjacency(MutableMapping):
+    """Edges from one node of a CompactGraph, as a {node id: weight} dict
+
+    A single edge is read in the CSR arrays, the dict of all the edges is built at the first
+    iteration and kept by this view until it changes them."""
+
+    def __init__(self, graph, i):
+        self.graph = graph
+        self.i = i
+        self._dict = None
+
+    def _edges(self):
+        if self._dict is None:
+            ids = self.graph.ids
+            self._dict = {ids[target]: weight for target, weight in self.graph.edges(self.i).items()}
+        return self._dict
+
+    def __getitem__(self, node_id):
+        if self._dict is not None:
+            return self._dict[node_id]
+        target = self.graph.index.get(node_id)
+        weight = None if target is None else self.graph.weight(self.i, target)
+        if weight is None:
+            raise KeyError(node_id)
+        return weight
+
+    def __setitem__(self, node_id, weight):
+        self.graph.set_edge(self.i, self.graph.index[node_id], weight)
+        self._dict = None
+
+    def __delitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        self.graph.set_edge(self.i, self.graph.index[node_id], None)
+        self._dict = None
+
+    def __iter__(self):
+        return iter(self._edges())
+
+    def __len__(self):
+        return len(self._edges())
+
+    def keys(self):
+        return self._edges().keys()
+
+    def items(self):
+        return self._edges().items()
+
+    def values(self):
+        return self._edges().values()
+
+
+class CompactRouting(MutableMapping):
+    """{node id: {node id: weight}} view of a CompactGraph"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __contains__(self, node_id):
+        i = self.graph.index.get(node_id)
+        return i is not None and self.graph.routable[i] == 1
+
+    def __getitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        return CompactAdjacency(self.graph, self.graph.index[node_id])
+
+    def __setitem__(self, node_id, edges):
+        i = self.graph.index.get(node_id)
+        if i is None:
+            # A node is routable only once its position is known
+            raise KeyError(node_id)
+        for target in self.graph.edges(i):
+            self.graph.set_edge(i, target, None)
+        self.graph.set_routable(i)
+        for target_id, weight in edges.items():
+            self.graph.set_edge(i, self.graph.index[target_id], weight)
+
+    def __delitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        i = self.graph.index[node_id]
+        for target in self.graph.edges(i):
+            self.graph.set_edge(i, target, None)
+        self.graph.set_routable(i, False)
+
+    def __iter__(self):
+        ids, routable = self.graph.ids, self.graph.routable
+        return (ids[i] for i in range(len(ids)) if routable[i])
+
+    def __len__(self):
+        return self.graph._routable_count
+
+
+class CompactNodes(MutableMapping):
+    """{node id: (lat, lon)} view of a CompactGraph"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __contains__(self, node_id):
+        return node_id in self.graph.index
+
+    def __getitem__(self, node_id):
+        i = self.graph.index[node_id]
+        return self.graph.lats[i], self.graph.lons[i]
+
+    def __setitem__(self, node_id, latlon):
+        self.graph.add_node(node_id, latlon[0], latlon[1])
+
+    def __delitem__(self, node_id):
+        raise TypeError("Nodes can't be removed from a compact graph")
+
+    def __iter__(self):
+        return iter(self.graph.index)
+
+    def __len__(self):
+        return len(self.graph.index)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+# Change it when the content or the layout of the compiled files change
+FORMAT_VERSION = 1
+MAGIC = b"RTTILE\0\0"
+
+# Arrays of a compiled file, in their order in the file
+ARRAYS = (("node_ids", np.int64), ("lats", np.float64), ("lons", np.float64),
+          ("edge_src", np.int32), ("edge_dst", np.int32), ("edge_cost", np.float64))
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def profile_signature(transport_type):
+    """Hash of a transport mode profile (access keys, oneway transport and weights), to invalidate compiled files"""
+    signature = hashlib.sha1()
+    signature.update(repr((transport_type.get("transport", transport_type.get("name")),
+                           transport_type["access"])).encode())
+    for key, weight in sorted(transport_type["weights"].items()):
+        if callable(weight):
+            code = weight.__code__
+            weight = (code.co_code, code.co_consts, code.co_names)
+        signature.update(repr((key, weight)).encode())
+    return signature.hexdigest()
+
+
+def source_version(filename):
+    """Version of an OSM source file: modification time and size"""
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class CompiledTile(object):
+    """What an OSM file adds to a Datastore for one transport mode
+
+    Nodes of the routable ways (in order of first use), edges with their travel costs (in store order,
+    as indexes of the nodes) and turn restrictions. It is built while parsing the OSM file, and saved
+    in a binary file read back with mmap.
+    """
+
+    def __init__(self):
+        self.node_ids = []
+        self.lats = []
+        self.lons = []
+        self.edge_src = []
+        self.edge_dst = []
+        self.edge_cost = []
+        # [kind ("no" or "only"), activator (from, via), nodes]
+        self.restrictions = []
+        self._node_index = {}
+
+    def add_node(self, node_id, lat, lon):
+        """Index of a node, added at its first use"""
+        i = self._node_index.get(node_id)
+        if i is None:
+            i = self._node_index[node_id] = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.lats.append(lat)
+            self.lons.append(lon)
+        return i
+
+    def add_edge(self, i, j, cost):
+        self.edge_src.append(i)
+        self.edge_dst.append(j)
+        self.edge_cost.append(cost)
+
+    def add_restriction(self, kind, activator, nodes):
+        self.restrictions.append([kind, list(activator), list(nodes)])
+
+    def save(self, filename, version):
+        """Write the compiled tile, with the version of its sources"""
+        header = json.dumps({"format": FORMAT_VERSION, "version": version, "nodes": len(self.node_ids),
+                             "edges": len(self.edge_src), "restrictions": self.restrictions}).encode()
+        tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, "wb") as hf:
+            hf.write(MAGIC)
+            hf.write(struct.pack("<Q", len(header)))
+            hf.write(header)
+            for name, dtype in ARRAYS:
+                hf.write(b"\0" * (_align(hf.tell()) - hf.tell()))
+                hf.write(np.asarray(getattr(self, name), dtype=dtype).tobytes())
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, version):
+        """Read a compiled tile, None if it is missing, broken or of another version"""
+        try:
+            with open(filename, "rb") as hf:
+                data = mmap.mmap(hf.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                return None
+            header_length, = struct.unpack_from("<Q", data, len(MAGIC))
+            offset = len(MAGIC) + 8
+            header = json.loads(data[offset:offset + header_length])
+            if header.get("format") != FORMAT_VERSION or header.get("version") != version:
+                return None
+            offset += header_length
+
+            tile = cls()
+            for name, dtype in ARRAYS:
+                count = header["nodes"] if name in ("node_ids", "lats", "lons") else header["edges"]
+                offset = _align(offset)
+                setattr(tile, name, np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+                offset += count * np.dtype(dtype).itemsize
+            tile.restrictions = header["restrictions"]
+            return tile
+        except (struct.error, ValueError, KeyError):
+            return None
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from functools import lru_cache
+
+import numpy as np
+
+from utils import distance, distance_array
+
+# Above this number of operations, the Held-Karp table is too long to build and the MST bound is used
+HELD_KARP_MAX_WORK = 50000000
+CACHE_SIZE = 1 << 20
+
+
+class MinDistHeuristic(object):
+    """Lower bound of the distance from a node to the route end, visiting one entry point of each remaining zone
+
+    Zones are numbered, a set of remaining zones is a bitmask of their indexes.
+    The distances between every pair of entry points are computed once, then the bound is either exact
+    for straight lines (Held-Karp dynamic programming over the zone bitmasks), or, with too many zones,
+    the minimum spanning tree of the zones. Both are admissible.
+    """
+
+    def __init__(self, router, zones, end):
+        self.router = router
+        self.zones = list(zones)
+        self.zone_bit = {zone: 1 << i for i, zone in enumerate(self.zones)}
+        self.end = router.node_lat_lon(end)
+
+        # Zones entered at each entry node
+        self.node_zones = {}
+        for zone in self.zones:
+            for node_id in zone.entry_nodes_id:
+                self.node_zones[node_id] = self.node_zones.get(node_id, 0) | self.zone_bit[zone]
+
+        # Entry points of every zone, zone after zone
+        latlons = []
+        self.zone_slices = []
+        for zone in self.zones:
+            start = len(latlons)
+            latlons += [n.latlon for n in zone.entryNodeId]
+            self.zone_slices.append(slice(start, len(latlons)))
+        self.lats = np.array([latlon[0] for latlon in latlons], dtype=float)
+        self.lons = np.array([latlon[1] for latlon in latlons], dtype=float)
+
+        self.matrix = np.array([distance_array(latlon, self.lats, self.lons) for latlon in latlons],
+                               dtype=float).reshape(len(latlons), len(latlons))
+        self.end_dist = distance_array(self.end, self.lats, self.lons)
+
+        self.held_karp = (1 << len(self.zones)) * len(latlons) ** 2 <= HELD_KARP_MAX_WORK
+        if self.held_karp:
+            self._build_held_karp()
+        else:
+            self._build_zone_distances()
+
+        self.min_dist = lru_cache(maxsize=CACHE_SIZE)(self._min_dist)
+
+    def zone_indexes(self, mask):
+        """Indexes of the zones of a bitmask"""
+        return [i for i in range(len(self.zones)) if mask >> i & 1]
+
+    def _build_held_karp(self):
+        """For each mask, compute the shortest path from each entry point to end, visiting the mask zones
+
+        to_end[mask][p] is this distance from the point p (the zones of p itself is not considered)
+        by_first[mask][p] is the distance to end, starting by point p of a mask zone (inf if not a mask zone)"""
+        count = 1 << len(self.zones)
+        self.to_end = np.empty((count, len(self.lats)))
+        self.by_first = np.full((count, len(self.lats)), np.inf)
+        self.to_end[0] = self.end_dist
+        for mask in range(1, count):
+            by_first = self.by_first[mask]
+            for i in self.zone_indexes(mask):
+                zone_slice = self.zone_slices[i]
+                by_first[zone_slice] = self.to_end[mask ^ (1 << i)][zone_slice]
+            if mask != count - 1:
+                self.to_end[mask] = (self.matrix + by_first).min(axis=1)
+
+    def _build_zone_distances(self):
+        """Minimum distance between every pair of zones, and to the end (last index)"""
+        zone_count = len(self.zones)
+        self.zone_matrix = np.zeros((zone_count + 1, zone_count + 1))
+        for i, slice_i in enumerate(self.zone_slices):
+            for j, slice_j in enumerate(self.zone_slices[:i]):
+                self.zone_matrix[i, j] = self.zone_matrix[j, i] = self.matrix[slice_i, slice_j].min()
+            self.zone_matrix[i, zone_count] = self.zone_matrix[zone_count, i] = self.end_dist[slice_i].min()
+        self._spanning_trees = {}
+
+    def _spanning_tree(self, mask):
+        """Weight of the minimum spanning tree between the mask zones and the end (Prim)"""
+        if mask not in self._spanning_trees:
+            nodes = self.zone_indexes(mask) + [len(self.zones)]
+            weights = self.zone_matrix[nodes[0], nodes]
+            in_tree = np.zeros(len(nodes), dtype=bool)
+            in_tree[0] = True
+            total = 0.0
+            for _ in range(len(nodes) - 1):
+                candidates = np.where(in_tree, np.inf, weights)
+                closest = int(candidates.argmin())
+                total += candidates[closest]
+                in_tree[closest] = True
+                weights = np.minimum(weights, self.zone_matrix[nodes[closest], nodes])
+            self._spanning_trees[mask] = total
+        return self._spanning_trees[mask]
+
+    def _min_dist(self, node, mask):
+        # The zones of an entry node are visited once it is reached: dropping them keeps the bound consistent
+        mask &= ~self.node_zones.get(node, 0)
+        latlon = self.router.node_lat_lon(node)
+        if mask == 0:
+            return distance(latlon, self.end)
+
+        dist = distance_array(latlon, self.lats, self.lons)
+        if self.held_karp:
+            return float((dist + self.by_first[mask]).min())
+
+        # A path visiting all the zones goes first to one of them, then spans all of them and the end
+        first = min(dist[self.zone_slices[i]].min() for i in self.zone_indexes(mask))
+        return float(first) + self._spanning_tree(mask)
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Import a local OSM extract (.osm or .pbf) in the tiles cache, without any call to the OSM API
+
+The extract is streamed three times (routable ways, their nodes, then the ways again) and split
+in the zoom 15 tiles data.osm files read by Datastore.get_tile. Only what the routing uses is kept:
+highway/railway ways with their nodes, and turn restrictions. The tiles of the extract without any
+routable way are written empty. Imported tiles don't expire, they are never downloaded from the API.
+"""
+
+import argparse
+import os
+import shutil
+import time
+import xml.etree.ElementTree as etree
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from pyroutelib3 import IMPORTED_TILE_HEADER, TYPES, ZOOM_LEVEL
+from tileloader import compile_tile_file
+
+# Buffered ways and node ids are appended to the tiles part files above this size (in bytes)
+BUFFER_SIZE = 64 * 1024 * 1024
+# Nodes are read by chunks of this size
+NODE_CHUNK = 1000000
+
+
+def _is_routable_way(tags):
+    return bool(tags.get("highway") or tags.get("railway"))
+
+
+def _is_restriction(tags):
+    return tags.get("type", "").startswith("restriction")
+
+
+def _read_xml(filename):
+    context = etree.iterparse(str(filename), events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end" or elem.tag not in ("node", "way", "relation"):
+            continue
+        tags = {i.attrib["k"]: i.attrib["v"] for i in elem.iter("tag")}
+        if elem.tag == "node":
+            yield "node", int(elem.attrib["id"]), (float(elem.attrib["lat"]), float(elem.attrib["lon"]))
+        elif elem.tag == "way":
+            yield "way", int(elem.attrib["id"]), ([int(i.attrib["ref"]) for i in elem.iter("nd")], tags)
+        else:
+            members = [(i.attrib["type"], int(i.attrib["ref"]), i.attrib.get("role", ""))
+                       for i in elem.iter("member")]
+            yield "relation", int(elem.attrib["id"]), (members, tags)
+        root.clear()
+
+
+def _read_pbf(filename):
+    try:
+        import osmium
+    except ImportError:
+        raise SystemExit("Reading .pbf files needs pyosmium: pip install osmium")
+    member_types = {"n": "node", "w": "way", "r": "relation"}
+    for obj in osmium.FileProcessor(str(filename)):
+        if obj.is_node():
+            if obj.location.valid():
+                yield "node", obj.id, (obj.location.lat, obj.location.lon)
+        elif obj.is_way():
+            yield "way", obj.id, ([n.ref for n in obj.nodes], {t.k: t.v for t in obj.tags})
+        elif obj.is_relation():
+            members = [(member_types[m.type], m.ref, m.role) for m in obj.members]
+            yield "relation", obj.id, (members, {t.k: t.v for t in obj.tags})
+
+
+def read_osm(filename):
+    """Stream the elements of an OSM file, as ("node", id, (lat, lon)), ("way", id, (refs, tags))
+    or ("relation", id, (members, tags))"""
+    if str(filename).endswith(".pbf"):
+        return _read_pbf(filename)
+    return _read_xml(filename)
+
+
+def tiles_xy(lats, lons):
+    """Zoom 15 tiles of arrays of coordinates (same computation than pyroutelib3._which_tile)"""
+    n = 2 ** ZOOM_LEVEL
+    lats = np.radians(lats)
+    x = np.floor(n * ((lons + 180) / 360))
+    y = np.floor(n * ((1 - np.log(np.tan(lats) + (1 / np.cos(lats))) / np.pi) / 2))
+    return x.astype(np.int64), y.astype(np.int64)
+
+
+def _way_xml(way_id, refs, tags):
+    return '<way id="{}">{}{}</way>\n'.format(
+        way_id, "".join('<nd ref="{}"/>'.format(ref) for ref in refs),
+        "".join("<tag k={} v={}/>".format(quoteattr(k), quoteattr(v)) for k, v in tags.items()))
+
+
+def _relation_xml(relation_id, members, tags):
+    return '<relation id="{}">{}{}</relation>\n'.format(
+        relation_id,
+        "".join('<member type="{}" ref="{}" role={}/>'.format(t, ref, quoteattr(role)) for t, ref, role in members),
+        "".join("<tag k={} v={}/>".format(quoteattr(k), quoteattr(v)) for k, v in tags.items()))
+
+
+class ExtractSplitter(object):
+    """Split an OSM extract in zoom 15 tiles, with a bounded memory
+
+    Only the coordinates of the routable nodes are kept in memory (as arrays), the ways of each
+    tile are buffered and appended to part files in a work directory."""
+
+    def __init__(self, filename, cache_dir):
+        self.filename = filename
+        self.cache_dir = cache_dir
+        self.work_dir = os.path.join(cache_dir, "import.tmp")
+        self.node_ids = None
+        self.lats = None
+        self.lons = None
+        self.tile_keys = None
+        # Turn restrictions, and the tiles of their ways
+        self.restrictions = {}
+        self.restriction_ways = {}
+        # Buffers of the ways and node ids of each tile (key: x << 32 | y)
+        self._ways = {}
+        self._nodes = {}
+        self._buffered = 0
+        # Tiles of the routable ways, and tiles of all the nodes of the extract
+        self.tiles = set()
+        self.extract_tiles = set()
+
+    def run(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+        start = time.time()
+        self._read_routable_node_ids()
+        print("{} routable nodes, {} restrictions ({:.0f}s)".format(len(self.node_ids), len(self.restrictions),
+                                                                     time.time() - start))
+        self._read_nodes()
+        print("nodes read ({:.0f}s)".format(time.time() - start))
+        self._split_ways()
+        print("{} tiles, {} without routable ways ({:.0f}s)".format(len(self.tiles),
+                                                                    len(self.extract_tiles - self.tiles),
+                                                                    time.time() - start))
+        files = self._write_tiles()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        print("tiles written ({:.0f}s)".format(time.time() - start))
+        return files
+
+    def _read_routable_node_ids(self):
+        """First pass: ids of the nodes of the routable ways, and the turn restrictions"""
+        node_ids = array('q')
+        for kind, element_id, data in read_osm(self.filename):
+            if kind == "way" and _is_routable_way(data[1]):
+                node_ids.extend(data[0])
+            elif kind == "relation" and _is_restriction(data[1]):
+                self.restrictions[element_id] = data
+                for member_type, ref, role in data[0]:
+                    if member_type == "way":
+                        self.restriction_ways[ref] = set()
+        self.node_ids = np.unique(np.frombuffer(node_ids, dtype=np.int64))
+        self.lats = np.full(len(self.node_ids), np.nan)
+        self.lons = np.full(len(self.node_ids), np.nan)
+
+    def _read_nodes(self):
+        """Second pass: coordinates of the routable nodes, and the tiles of all the nodes"""
+        ids, lats, lons = array('q'), array('d'), array('d')
+        for kind, element_id, data in read_osm(self.filename):
+            if kind != "node":
+                continue
+            ids.append(element_id)
+            lats.append(data[0])
+            lons.append(data[1])
+            if len(ids) >= NODE_CHUNK:
+                self._store_nodes(ids, lats, lons)
+                ids, lats, lons = array('q'), array('d'), array('d')
+        self._store_nodes(ids, lats, lons)
+        known = ~np.isnan(self.lats)
+        x, y = tiles_xy(np.where(known, self.lats, 0), np.where(known, self.lons, 0))
+        self.tile_keys = np.where(known, x << 32 | y, -1)
+
+    def _store_nodes(self, ids, lats, lons):
+        if not ids:
+            return
+        x, y = tiles_xy(np.frombuffer(lats), np.frombuffer(lons))
+        self.extract_tiles.update(np.unique(x << 32 | y).tolist())
+        if not len(self.node_ids):
+            return
+        ids = np.frombuffer(ids, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.node_ids, ids), len(self.node_ids) - 1)
+        routable = self.node_ids[index] == ids
+        self.lats[index[routable]] = np.frombuffer(lats)[routable]
+        self.lons[index[routable]] = np.frombuffer(lons)[routable]
+
+    def _split_ways(self):
+        """Third pass: routable ways, in the tiles of their nodes"""
+        for kind, element_id, data in read_osm(self.filename):
+            if kind != "way" or not _is_routable_way(data[1]):
+                continue
+            refs, tags = data
+            index = np.searchsorted(self.node_ids, refs)
+            keys = self.tile_keys[index]
+            refs = np.asarray(refs, dtype=np.int64)[keys >= 0]
+            keys = np.unique(keys[keys >= 0])
+            if not len(keys):
+                continue
+            xml = _way_xml(element_id, data[0], tags)
+            ref_list = refs.tolist()
+            for key in keys.tolist():
+                self._ways.setdefault(key, []).append(xml)
+                self._nodes.setdefault(key, array('q')).extend(ref_list)
+                self.tiles.add(key)
+            if element_id in self.restriction_ways:
+                self.restriction_ways[element_id].update(keys.tolist())
+            self._buffered += len(keys) * (len(xml) + 8 * len(refs))
+            if self._buffered > BUFFER_SIZE:
+                self._flush()
+        self._flush()
+
+    def _flush(self):
+        for key, ways in self._ways.items():
+            with open(os.path.join(self.work_dir, "{}.ways".format(key)), "a", encoding="utf-8") as hf:
+                hf.writelines(ways)
+        for key, nodes in self._nodes.items():
+            with open(os.path.join(self.work_dir, "{}.nodes".format(key)), "ab") as hf:
+                nodes.tofile(hf)
+        self._ways = {}
+        self._nodes = {}
+        self._buffered = 0
+
+    def _write_tiles(self):
+        """Write the data.osm file of each tile: its nodes, ways and restrictions
+
+        Return the files of the tiles with routable ways, the other tiles of the extract are written empty."""
+        relations = {}
+        for relation_id, (members, tags) in self.restrictions.items():
+            keys = set()
+            for member_type, ref, role in members:
+                if member_type == "way":
+                    keys.update(self.restriction_ways[ref])
+            for key in keys:
+                relations.setdefault(key, []).append(_relation_xml(relation_id, members, tags))
+
+        files = []
+        for key in sorted(self.tiles | self.extract_tiles):
+            x, y = key >> 32, key & 0xffffffff
+            directory = os.path.join(self.cache_dir, str(ZOOM_LEVEL), str(x), str(y))
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, "data.osm")
+            if key not in self.tiles:
+                with open(filename, "w", encoding="utf-8") as hf:
+                    hf.write(IMPORTED_TILE_HEADER)
+                    hf.write('</osm>\n')
+                continue
+
+            part = os.path.join(self.work_dir, str(key))
+            refs = np.unique(np.fromfile(part + ".nodes", dtype=np.int64))
+            index = np.searchsorted(self.node_ids, refs)
+            with open(filename, "w", encoding="utf-8") as hf:
+                hf.write(IMPORTED_TILE_HEADER)
+                hf.writelines('<node id="{}" lat="{:.7f}" lon="{:.7f}"/>\n'.format(node_id, lat, lon)
+                              for node_id, lat, lon in zip(refs.tolist(), self.lats[index].tolist(),
+                                                           self.lons[index].tolist()))
+                with open(part + ".ways", encoding="utf-8") as ways:
+                    shutil.copyfileobj(ways, hf)
+                hf.writelines(relations.get(key, []))
+                hf.write('</osm>\n')
+            files.append(filename)
+        return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import an OSM extract in the tiles cache')
+    parser.add_argument('extract', help="OSM extract (.osm, or .pbf with pyosmium installed)")
+    parser.add_argument('--cache-dir', default=str(Path.home().joinpath('.tilescache')),
+                        help="Tiles cache of the server")
+    parser.add_argument('--compile', nargs='*', default=[], choices=sorted(TYPES), metavar='MODE',
+                        help="Also compile the tiles for these transport modes")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="Processes compiling the tiles")
+    args = parser.parse_args()
+
+    tile_files = ExtractSplitter(args.extract, args.cache_dir).run()
+
+    if args.compile:
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            jobs = [executor.submit(compile_tile_file, mode, file) for mode in args.compile for file in tile_files]
+            for job in jobs:
+                job.result()
+        print("{} tiles compiled for {} ({:.0f}s)".format(len(tile_files), ", ".join(args.compile),
+                                                         time.time() - start_time))
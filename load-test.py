@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Load test of a running route-tiles server
+
+Some users compute routes while others poll /route_status: the polling latency shouldn't
+depend on the routes being computed."""
+
+import argparse
+import json
+import threading
+import time
+from urllib import parse
+from urllib.request import urlopen
+
+
+def get(server, path, params=None):
+    """Send a GET request to the server, return its answer and its latency in s"""
+    url = "{}/{}?{}".format(server, path, parse.urlencode(params or {}, doseq=True))
+    start_time = time.perf_counter()
+    with urlopen(url, timeout=600) as response:
+        answer = response.read()
+    return answer, time.perf_counter() - start_time
+
+
+def get_json(server, path, params=None):
+    answer, latency = get(server, path, params)
+    return json.loads(answer.decode('utf-8')), latency
+
+
+def percentile(values, q):
+    """Nearest rank percentile of a sorted list"""
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.static_latencies = []
+        self.routes = []
+        self.errors = 0
+
+    def route_user(self):
+        """Start a route and poll its status until it is complete, again and again"""
+        args = self.args
+        params = {'start[]': args.start, 'end[]': args.end or args.start, 'mode': args.mode,
+                  'turnaroundCost': 0, 'tiles[]': args.tiles}
+        while not self.stop.is_set():
+            try:
+                start_time = time.perf_counter()
+                answer, latency = get_json(args.server, 'start_route', params)
+                params['sessionId'] = answer['sessionId']
+                while answer.get('state') == 'searching' and not self.stop.is_set():
+                    time.sleep(args.interval)
+                    answer, latency = get_json(args.server, 'route_status', {'sessionId': params['sessionId']})
+                    with self.lock:
+                        self.latencies.append(latency)
+                if answer.get('state') == 'complete':
+                    with self.lock:
+                        self.routes.append(time.perf_counter() - start_time)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+
+    def poll_user(self):
+        """Poll route_status of a session without route, or a static file"""
+        args = self.args
+        session_id = None
+        while not self.stop.is_set():
+            try:
+                if args.static:
+                    answer, latency = get(args.server, args.static)
+                    with self.lock:
+                        self.static_latencies.append(latency)
+                else:
+                    params = {'sessionId': session_id} if session_id else {}
+                    answer, latency = get_json(args.server, 'route_status', params)
+                    session_id = answer['sessionId']
+                    with self.lock:
+                        self.latencies.append(latency)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+            time.sleep(args.interval)
+
+    def run(self):
+        threads = [threading.Thread(target=self.route_user) for _ in range(self.args.routes)]
+        threads += [threading.Thread(target=self.poll_user) for _ in range(self.args.pollers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+
+    def report(self):
+        for name, latencies in (("route_status", self.latencies), (self.args.static, self.static_latencies)):
+            latencies = sorted(latencies)
+            if latencies:
+                print("{}: {} requests, p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+                    name, len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                    latencies[-1] * 1000))
+        if self.routes:
+            print("routes: {} completed, mean {:.1f}s".format(len(self.routes), sum(self.routes) / len(self.routes)))
+        print("errors: {}".format(self.errors))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency of /route_status while routes are being computed')
+    parser.add_argument('--server', default='http://localhost:8000', help="URL of the running server")
+    parser.add_argument('--routes', type=int, default=2, help="Users computing routes")
+    parser.add_argument('--pollers', type=int, default=8, help="Users polling route_status")
+    parser.add_argument('--static', help="Static file polled instead of route_status (index.html)")
+    parser.add_argument('--duration', type=float, default=30, help="Test duration in s")
+    parser.add_argument('--interval', type=float, default=0.1, help="Polling interval in s")
+    parser.add_argument('--mode', default='roadcycle', help="Transport mode of the routes")
+    parser.add_argument('--start', nargs=2, type=float, required=True, metavar=('LAT', 'LON'))
+    parser.add_argument('--end', nargs=2, type=float, metavar=('LAT', 'LON'), help="Route end (default: a loop)")
+    parser.add_argument('--tiles', nargs='*', default=[], help="Tiles to visit (x_y, zoom 14)")
+    args = parser.parse_args()
+
+    load_test = LoadTest(args)
+    load_test.run()
+    load_test.report()
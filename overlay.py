@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections.abc import Mapping
+
+from spatialindex import GridIndex
+
+
+class OverlayRouting(Mapping):
+    """{node id: {node id: cost}} view of a shared routing graph, with the edges changed by one request"""
+
+    def __init__(self, base, lock):
+        self.base = base
+        # Held by the tiles merges, taken to iterate over the whole shared graph
+        self.lock = lock
+        # node id -> {node id: cost, or None if the edge is removed}
+        self.changes = {}
+
+    def __contains__(self, node_id):
+        return node_id in self.changes or node_id in self.base
+
+    def __getitem__(self, node_id):
+        changes = self.changes.get(node_id)
+        if changes is None:
+            return self.base[node_id]
+        # The shared edges of a node are replaced by a merge, never changed: copied without the lock
+        edges = dict(self.base[node_id].items()) if node_id in self.base else {}
+        for target, cost in changes.items():
+            if cost is None:
+                edges.pop(target, None)
+            else:
+                edges[target] = cost
+        return edges
+
+    def __iter__(self):
+        with self.lock:
+            nodes = list(self.base)
+        yield from nodes
+        for node_id in self.changes:
+            if node_id not in self.base:
+                yield node_id
+
+    def __len__(self):
+        with self.lock:
+            return len(self.base) + sum(1 for node_id in self.changes if node_id not in self.base)
+
+    def set_edge(self, node_a, node_b, cost):
+        self.changes.setdefault(node_a, {})[node_b] = cost
+
+
+class OverlayNodes(Mapping):
+    """{node id: (lat, lon)} view of shared nodes, with the nodes added by one request"""
+
+    def __init__(self, base, lock):
+        self.base = base
+        self.lock = lock
+        self.added = {}
+
+    def __contains__(self, node_id):
+        return node_id in self.added or node_id in self.base
+
+    def __getitem__(self, node_id):
+        if node_id in self.added:
+            return self.added[node_id]
+        return self.base[node_id]
+
+    def __iter__(self):
+        with self.lock:
+            nodes = list(self.base)
+        yield from nodes
+        for node_id in self.added:
+            if node_id not in self.base:
+                yield node_id
+
+    def __len__(self):
+        with self.lock:
+            return len(self.base) + sum(1 for node_id in self.added if node_id not in self.base)
+
+
+class OverlayIndex(object):
+    """Spatial index of the shared nodes and of the nodes added by one request"""
+
+    def __init__(self, base):
+        self.base = base
+        self.added = GridIndex()
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+    def add(self, node_id, lat, lon):
+        self.added.add(node_id, lat, lon)
+
+    def nearest(self, lat, lon, k=1, accept=None):
+        return sorted(self.base.nearest(lat, lon, k, accept) + self.added.nearest(lat, lon, k, accept))[:k]
+
+    def within(self, lat, lon, radius):
+        return self.base.within(lat, lon, radius) + self.added.within(lat, lon, radius)
+
+
+class DatastoreOverlay(object):
+    """Layer of one request on a Datastore shared by all the requests of a transport mode
+
+    The nodes and edges added, changed or removed by the request (tile entry points) are kept in the
+    overlay, the shared graph is only read. Tiles loading and everything else goes to the shared Datastore.
+    The shared graph is read without lock, as the Datastore merges tiles (see Datastore): only the
+    iterations over all its nodes take its graph_lock.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.routing = OverlayRouting(base.routing, base.graph_lock)
+        self.rnodes = OverlayNodes(base.rnodes, base.graph_lock)
+        self.node_index = OverlayIndex(base.node_index)
+        # Used for every searched edge
+        self.get_area = base.get_area
+        self.mandatoryMoves = base.mandatoryMoves
+        self.next_restriction_state = base.next_restriction_state
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def node_lat_lon(self, node):
+        """Get node's lat lon"""
+        return self.rnodes[node]
+
+    def add_node(self, node_id, lat, lon):
+        """Store node's lat lon, in the overlay"""
+        if node_id not in self.rnodes:
+            self.node_index.add(node_id, lat, lon)
+        self.rnodes.added[node_id] = (lat, lon)
+
+    def set_edge(self, node_a, node_b, cost):
+        """Add or update the edge node_a -> node_b, in the overlay"""
+        self.routing.set_edge(node_a, node_b, cost)
+
+    def remove_edge(self, node_a, node_b):
+        """Remove the edge node_a -> node_b, in the overlay"""
+        if node_b not in self.routing[node_a]:
+            raise KeyError(node_b)
+        self.routing.set_edge(node_a, node_b, None)
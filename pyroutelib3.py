@@ -35,10 +35,15 @@
 # ----------------------------------------------------------------------------
 import math
 import os
+import threading
 import time
 import xml.etree.ElementTree as etree
+from array import array
 from urllib.request import urlretrieve
 
+from compactgraph import CompactGraph
+from compiledtile import CompiledTile, profile_signature, source_version
+from spatialindex import GridIndex
 from utils import distance, retry
 
 __title__ = "pyroutelib3"
@@ -114,6 +119,10 @@ TYPES = {
 }
 
 ZOOM_LEVEL = 15
+# Header of the tiles written by import-osm.py: they are never downloaded again from the OSM API
+# A tile which failed to load is tried again after this delay (in s)
+TILE_RETRY_DELAY = 600
+IMPORTED_TILE_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="route-tiles import">\n'
 
 
 def _which_tile(lat, lon, zoom):
@@ -138,6 +147,15 @@ def _tile_boundary(x, y, z):
     return left, bottom, right, top
 
 
+def is_imported_tile(filename):
+    """Check if a tile file was written by import-osm.py"""
+    try:
+        with open(filename, "rb") as hf:
+            return hf.read(len(IMPORTED_TILE_HEADER)) == IMPORTED_TILE_HEADER.encode()
+    except OSError:
+        return False
+
+
 @retry(Exception, tries=6, delay=30, backoff=2)
 def myurlretrieve(url, filename=None, reporthook=None, data=None):
     return urlretrieve(url, filename, reporthook, data)
@@ -187,21 +205,47 @@ def equivalent(tag):
 
 
 class Datastore:
-    """Object for storing routing data with basic OSM parsing functionality"""
+    """Object for storing routing data with basic OSM parsing functionality
 
-    def __init__(self, transport, localfile=False, expire_data=30, storage_class=dict, cache_dir="tilescache"):
+    Searches read the graph without any lock, while other threads merge tiles in it. A merge, done with
+    graph_lock held, never changes what a search may be holding: nodes are added before the edges to
+    them, and the edges dict of a node and the forbidden moves list of an edge are replaced by new ones,
+    never changed. A tile is in self.tiles once merged, get_tile waits for a tile being merged. Code
+    iterating over the whole graph takes graph_lock."""
+
+    def __init__(self, transport, localfile=False, expire_data=30, storage_class=dict, cache_dir="tilescache",
+                 compact_graph=False):
         """Initialise an OSM-file parser"""
         # Routing data
         print("############ DATASTORE init ################")
-        self.routing = storage_class()
+        self.compact_graph = compact_graph
+        if compact_graph:
+            # Array backed graph, routing and rnodes are views on it
+            self.graph = CompactGraph()
+            self.routing = self.graph.routing
+            self.rnodes = self.graph.rnodes
+        else:
+            self.routing = storage_class()
+            self.rnodes = storage_class()
+        # Spatial index of rnodes, for the nearest node searches
+        self.node_index = GridIndex()
         self.not_update_routing = storage_class()
-        self.rnodes = storage_class()
+        # Turn restrictions, indexed by their (from, via) nodes
         self.mandatoryMoves = storage_class()
         self.forbiddenMoves = storage_class()
         self.cache_dir = cache_dir
 
         # Info about OSM
         self.tiles = storage_class()
+        # Tiles which failed to load, with the time they can be tried again
+        self.failed_tiles = {}
+        # Tiles are downloaded and parsed with their own lock held, then merged one at a time in the graph
+        # with graph_lock held: searches can read the graph meanwhile
+        self.graph_lock = threading.RLock()
+        self._tile_locks = {}
+        self._tile_locks_lock = threading.Lock()
+        # Optional TileLoader, loading tiles in background
+        self.tile_loader = None
         self.expire_data = 86400 * expire_data  # expire_data is in days, we preform calculations in seconds
         self.localFile = bool(localfile)
 
@@ -213,10 +257,12 @@ class Datastore:
             # Check if required info is in given transport dict
             assert {"name", "access", "weights"}.issubset(transport.keys())
             self.transport = transport["name"]
+            self.mode = transport["name"]
             self.type = transport
 
         else:
             self.transport = TYPES[transport].get('transport')
+            self.mode = transport
             self.type = TYPES[transport].copy()
 
         # Load local file if it was passed
@@ -224,10 +270,17 @@ class Datastore:
             self.load_osm(localfile)
 
     def clean(self):
-        self.routing = self.storage_class()
+        if self.compact_graph:
+            self.graph = CompactGraph()
+            self.routing = self.graph.routing
+            self.rnodes = self.graph.rnodes
+            self.node_index = GridIndex()
+        else:
+            self.routing = self.storage_class()
 
         # Info about OSM
         self.tiles = self.storage_class()
+        self.failed_tiles = {}
 
     def _allowed_vehicle(self, tags):
         """Check way against access tags"""
@@ -249,6 +302,25 @@ class Datastore:
         """Get node's lat lon"""
         return self.rnodes[node]
 
+    def add_node(self, node_id, lat, lon):
+        """Store node's lat lon"""
+        if node_id not in self.rnodes:
+            self.node_index.add(node_id, lat, lon)
+        self.rnodes[node_id] = (lat, lon)
+
+    def set_edge(self, node_a, node_b, cost):
+        """Add or update the edge node_a -> node_b"""
+        if node_a not in self.routing:
+            self.routing[node_a] = {}
+        self.routing[node_a][node_b] = cost
+
+    def remove_edge(self, node_a, node_b):
+        """Remove the edge node_a -> node_b, it won't be restored by the next loaded data"""
+        self.routing[node_a].pop(node_b)
+        if node_a not in self.not_update_routing:
+            self.not_update_routing[node_a] = []
+        self.not_update_routing[node_a].append(node_b)
+
     def get_area(self, lat, lon):
         """Download data in the vicinity of a lat/long"""
         # Don't download data if we loaded a custom OSM file
@@ -266,28 +338,103 @@ class Datastore:
         if self.localFile:
             return
 
+        for x, y, z in self._area_tiles(lat1, lon1, lat2, lon2):
+            self.get_tile(x, y, z)
+
+    def _area_tiles(self, lat1, lon1, lat2, lon2):
+        """OSM tiles (x, y, z) covering a rectangle"""
         # Get info on tile in wich lat, lon lays
         x1, y1, z1 = _which_tile(lat1, lon1, ZOOM_LEVEL)
         x2, y2, z2 = _which_tile(lat2, lon2, ZOOM_LEVEL)
-        for x in range(min(x1, x2), max(x1, x2) + 1):
-            for y in range(min(y1, y2), max(y1, y2) + 1):
-                self.get_tile(x, y, z1)
+        return [(x, y, z1) for x in range(min(x1, x2), max(x1, x2) + 1) for y in range(min(y1, y2), max(y1, y2) + 1)]
+
+    def area_version(self, lat1, lon1, lat2, lon2):
+        """Version of the OSM data of a rectangle: the modification times of its tiles cache files
+
+        None if the data doesn't come from the tiles cache"""
+        if self.localFile:
+            return None
+        version = []
+        for x, y, z in self._area_tiles(lat1, lon1, lat2, lon2):
+            filename = os.path.join(self.cache_dir, "{}".format(z), str(x), str(y), "data.osm")
+            try:
+                version.append([filename, os.stat(filename).st_mtime_ns])
+            except OSError:
+                return None
+        return version
 
     def get_tile(self, x, y, z):
         tile_id = "{0},{1}".format(x, y)
 
-        # Don't redownload tiles
-        if tile_id in self.tiles:
+        # Don't redownload tiles, nor tiles which just failed
+        if not self.should_load(tile_id):
+            return
+
+        # Being loaded in background: wait for it
+        if self.tile_loader is not None and self.tile_loader.wait(tile_id):
             return
 
-        # Download tile data
-        self.tiles[tile_id] = True
+        self.load_tile(x, y, z)
+
+    def load_tile(self, x, y, z):
+        """Load a tile (downloaded if needed), if not already loaded
+
+        Only the lock of the tile is held while it is downloaded and parsed: a slow download doesn't
+        hold the loading of the other tiles."""
+        tile_id = "{0},{1}".format(x, y)
+        with self._tile_lock(tile_id):
+            # It may have been loaded by another thread meanwhile
+            if tile_id in self.tiles:
+                return
+            try:
+                compiled = self._compile_tile(x, y, z)
+            except Exception:
+                self.tile_failed(tile_id)
+                raise
+            with self.graph_lock:
+                self.apply_compiled(compiled)
+                self.tiles[tile_id] = True
+            self.failed_tiles.pop(tile_id, None)
+
+    def should_load(self, tile_id):
+        """Check if a tile is neither loaded nor failed less than TILE_RETRY_DELAY ago"""
+        return tile_id not in self.tiles and self.failed_tiles.get(tile_id, 0) <= time.time()
+
+    def tile_failed(self, tile_id):
+        """A tile couldn't be loaded: searches go on without it until TILE_RETRY_DELAY"""
+        self.failed_tiles[tile_id] = time.time() + TILE_RETRY_DELAY
+
+    def _tile_lock(self, tile_id):
+        with self._tile_locks_lock:
+            lock = self._tile_locks.get(tile_id)
+            if lock is None:
+                lock = self._tile_locks[tile_id] = threading.Lock()
+            return lock
+
+    def _compile_tile(self, x, y, z):
+        """Compiled data of a tile, downloaded if needed"""
+        filename = self.download_tile(x, y, z)
+        try:
+            return self.compiled_osm(filename)
+        except etree.ParseError:
+            if is_imported_tile(filename):
+                raise
+            left, bottom, right, top = _tile_boundary(x, y, ZOOM_LEVEL)
+            myurlretrieve(
+                "https://api.openstreetmap.org/api/0.6/map?bbox={0},{1},{2},{3}".format(left, bottom, right, top),
+                filename)
+            return self.compiled_osm(filename)
+
+    def download_tile(self, x, y, z):
+        """Download tile data in the tiles cache, if missing or expired, and return its file name
+
+        Tiles imported from an extract don't expire."""
         directory = os.path.join(self.cache_dir, "{}".format(z), str(x), str(y))
         filename = os.path.join(directory, "data.osm")
 
         # Make sure directory to which we download .osm files exists
         if not os.path.exists(directory):
-            os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
 
         # In versions prior to 1.0 tiles were saved to tilescache/z/x/y/data.osm.pkl
         elif os.path.exists(filename + ".pkl"):
@@ -299,27 +446,29 @@ class Datastore:
         except OSError:
             downloaded_seconds_ago = math.inf
 
-        if downloaded_seconds_ago >= self.expire_data:
+        if downloaded_seconds_ago >= self.expire_data and not is_imported_tile(filename):
             left, bottom, right, top = _tile_boundary(x, y, z)
             myurlretrieve(
                 "https://api.openstreetmap.org/api/0.6/map?bbox={0},{1},{2},{3}".format(left, bottom, right, top),
                 filename)
-        try:
-            self.load_osm(filename)
-        except etree.ParseError:
-            left, bottom, right, top = _tile_boundary(x, y, ZOOM_LEVEL)
-            myurlretrieve(
-                "https://api.openstreetmap.org/api/0.6/map?bbox={0},{1},{2},{3}".format(left, bottom, right, top),
-                filename)
-            self.load_osm(filename)
+        return filename
 
-    def parse_osm_file(self, file):
-        """Return nodes, ways and realations of given file
-           Only highway=* and railway=* ways are returned, and
-           only type=restriction (and type=restriction:<transport type>) are returned"""
-        nodes = self.storage_class()
-        ways = self.storage_class()
-        relations = self.storage_class()
+    def parse_osm_file(self, file, compiled):
+        """Parse an OSM file in one streaming pass, adding its routable ways and turn restrictions to compiled
+
+        Only the nodes coordinates and the nodes of the highway=* and railway=* ways (for the turn
+        restrictions) are kept while parsing, the elements are cleared once read. As in the OSM files,
+        nodes must come before the ways, and ways before the relations."""
+        # Nodes coordinates, by index in lats and lons
+        node_index = {}
+        lats, lons = array('d'), array('d')
+        # Nodes of the highway=* and railway=* ways, as (start, end) slices of way_refs
+        way_slices = {}
+        way_refs = array('q')
+
+        def way_nodes(way_id):
+            start, end = way_slices[way_id]
+            return way_refs[start:end].tolist()
 
         # Check if a file-like object was passed
         if hasattr(file, "read"):
@@ -330,78 +479,172 @@ class Datastore:
             fp = open(os.fspath(file), "r", encoding="utf-8")
 
         try:
-            for event, elem in etree.iterparse(fp):
-                data = attributes(elem)
-                data["tag"] = {i.attrib["k"]: i.attrib["v"] for i in elem.iter("tag")}
+            context = etree.iterparse(fp, events=("start", "end"))
+            _, root = next(context)
+            for event, elem in context:
+                if event != "end":
+                    continue
 
                 if elem.tag == "node":
-                    nodes[data["id"]] = data
+                    attrib = elem.attrib
+                    node_index[int(attrib["id"])] = len(lats)
+                    lats.append(float(attrib["lat"]))
+                    lons.append(float(attrib["lon"]))
+
+                # Only potentially routable ways, their edges are added right away
+                elif elem.tag == "way":
+                    tags = {i.attrib["k"]: i.attrib["v"] for i in elem.iter("tag")}
+                    if tags.get("highway") or tags.get("railway"):
+                        refs = [int(i.attrib["ref"]) for i in elem.iter("nd")]
+                        way_slices[int(elem.attrib["id"])] = (len(way_refs), len(way_refs) + len(refs))
+                        way_refs.extend(refs)
+                        nodes = []
+                        for ref in refs:
+                            index = node_index.get(ref)
+                            if index is not None:
+                                nodes.append((ref, lats[index], lons[index]))
+                        self._compile_way(compiled, tags, nodes)
+
+                # Only potential turn restrictions
+                elif elem.tag == "relation":
+                    tags = {i.attrib["k"]: i.attrib["v"] for i in elem.iter("tag")}
+                    if tags.get("type", "").startswith("restriction"):
+                        members = [(i.attrib["type"], int(i.attrib["ref"]), i.attrib.get("role", ""))
+                                   for i in elem.iter("member")]
+                        self._compile_relation(compiled, tags, members, way_nodes)
 
-                # Store only potentially routable ways
-                elif elem.tag == "way" and (data["tag"].get("highway") or data["tag"].get("railway")):
-                    data["nd"] = [int(i.attrib["ref"]) for i in elem.iter("nd")]
-                    ways[data["id"]] = data
+                else:
+                    continue
 
-                # Store only potential turn restrictions
-                elif elem.tag == "relation" and data["tag"].get("type", "").startswith("restriction"):
-                    data["member"] = [attributes(i) for i in elem.iter("member")]
-                    relations[data["id"]] = data
+                # The element and its children are not needed anymore
+                root.clear()
 
         finally:
             # Close file if a path was passed
             if not hasattr(file, "read"):
                 fp.close()
 
-        return nodes, ways, relations
-
     def load_osm(self, file):
         """Load data from OSM file to self"""
-        nodes, ways, relations = self.parse_osm_file(file)
+        self.apply_compiled(self.compile_osm(file))
+
+    def load_compiled_osm(self, filename):
+        """Load data from OSM file to self, through its compiled file for the transport mode"""
+        self.apply_compiled(self.compiled_osm(filename))
+
+    def compiled_osm(self, filename):
+        """Compiled OSM file for the transport mode
+
+        The compiled file is written at the first use, and used as long as the OSM file
+        and the transport profile are the same."""
+        compiled_filename = os.path.join(os.path.dirname(filename), "compiled.{}.bin".format(self.mode))
+        version = [source_version(filename), profile_signature(self.type)]
+        compiled = CompiledTile.load(compiled_filename, version)
+        if compiled is None:
+            compiled = self.compile_osm(filename)
+            try:
+                compiled.save(compiled_filename, version)
+            except OSError:
+                pass
+        return compiled
+
+    def compile_osm(self, file):
+        """Parse an OSM file into what it adds for the transport mode: nodes, edges and restrictions"""
+        compiled = CompiledTile()
+        self.parse_osm_file(file, compiled)
+        return compiled
+
+    def _compile_relation(self, compiled, tags, members, way_nodes):
+        """Add a turn restriction relation, members are (type, ref, role) and way_nodes(way id) the nodes of a way"""
+        try:
+            # Ignore reltions which are not restrictions
+            if tags.get("type") not in ("restriction", "restriction:" + self.transport):
+                return
 
-        for wayId, wayData in ways.items():
-            way_nodes = []
-            for nd in wayData["nd"]:
-                if nd not in nodes:
-                    continue
-                way_nodes.append((nodes[nd]["id"], nodes[nd]["lat"], nodes[nd]["lon"]))
-            self.store_way(wayData["tag"], way_nodes)
+            # Ignore restriction if except tag points to any "access" values
+            if set(tags.get("except", "").split(";")).intersection(self.type["access"]):
+                return
 
-        for relId, relData in relations.items():
-            try:
-                # Ignore reltions which are not restrictions
-                if relData["tag"].get("type") not in ("restriction", "restriction:" + self.transport):
-                    continue
+            # Ignore foot restrictions unless explicitly stated
+            if self.transport == "foot" and tags.get("type") != "restriction:foot" and \
+                    "restriction:foot" not in tags:
+                return
 
-                # Ignore restriction if except tag points to any "access" values
-                if set(relData["tag"].get("except", "").split(";")).intersection(self.type["access"]):
-                    continue
+            restriction_type = tags.get("restriction:" + self.transport) or tags["restriction"]
 
-                # Ignore foot restrictions unless explicitly stated
-                if self.transport == "foot" and relData["tag"].get("type") != "restriction:foot" and \
-                        "restriction:foot" not in relData["tag"]:
-                    continue
+            nodes = []
+            from_member = [i for i in members if i[2] == "from"][0]
+            to_member = [i for i in members if i[2] == "to"][0]
 
-                restriction_type = relData["tag"].get("restriction:" + self.transport) or relData["tag"]["restriction"]
+            for member_type, ref, role in members:
+                if role != "via":
+                    continue
+                if member_type == "way":
+                    nodes.append(way_nodes(ref))
+                else:
+                    nodes.append([ref])
 
-                nodes = []
-                from_member = [i for i in relData["member"] if i["role"] == "from"][0]
-                to_member = [i for i in relData["member"] if i["role"] == "to"][0]
+            nodes.insert(0, way_nodes(from_member[1]))
+            nodes.append(way_nodes(to_member[1]))
 
-                for via_member in [i for i in relData["member"] if i["role"] == "via"]:
-                    if via_member["type"] == "way":
-                        nodes.append(ways[int(via_member["ref"])]["nd"])
-                    else:
-                        nodes.append([int(via_member["ref"])])
+            self._compile_restriction(compiled, restriction_type, nodes)
 
-                nodes.insert(0, ways[int(from_member["ref"])]["nd"])
-                nodes.append(ways[int(to_member["ref"])]["nd"])
+        except (KeyError, AssertionError, IndexError):
+            return
 
-                self.store_restriction(restriction_type, nodes)
+    def apply_compiled(self, compiled):
+        """Add the nodes, edges and restrictions of a compiled OSM file"""
+        node_ids = compiled.node_ids
+        if not isinstance(node_ids, list):
+            node_ids = node_ids.tolist()
+        lats, lons = compiled.lats, compiled.lons
+        if not isinstance(lats, list):
+            lats, lons = lats.tolist(), lons.tolist()
 
-            except (KeyError, AssertionError, IndexError):
-                continue
+        for node_id, lat, lon in zip(node_ids, lats, lons):
+            # Check if nodes' positions are stored
+            if node_id not in self.rnodes:
+                self.add_node(node_id, lat, lon)
+            # Check if nodes have dicts for storing travel costs
+            if node_id not in self.routing:
+                self.routing[node_id] = {}
+
+        edges = zip(compiled.edge_src, compiled.edge_dst, compiled.edge_cost)
+        if not isinstance(compiled.edge_src, list):
+            edges = zip(compiled.edge_src.tolist(), compiled.edge_dst.tolist(), compiled.edge_cost.tolist())
+        new_edges = {}
+        for i, j, cost in edges:
+            node1_id, node2_id = node_ids[i], node_ids[j]
+            if node1_id not in self.not_update_routing or node2_id not in self.not_update_routing[node1_id]:
+                new_edges.setdefault(node1_id, {})[node2_id] = cost
+
+        # The edges of a node are replaced at once, the dict read by a search doesn't change
+        for node_id, node_edges in new_edges.items():
+            if self.compact_graph:
+                # Compact graph edges are set one at a time, each one replaced at once
+                adjacency = self.routing[node_id]
+                for target, cost in node_edges.items():
+                    adjacency[target] = cost
+            else:
+                merged = dict(self.routing[node_id])
+                merged.update(node_edges)
+                self.routing[node_id] = merged
+
+        for kind, activator, nodes in compiled.restrictions:
+            activator = tuple(activator)
+            if kind == "no":
+                moves = self.forbiddenMoves.get(activator, [])
+                if tuple(nodes) not in moves:
+                    self.forbiddenMoves[activator] = moves + [tuple(nodes)]
+            else:
+                self.mandatoryMoves[activator] = list(nodes)
 
     def store_restriction(self, restriction_type, members):
+        compiled = CompiledTile()
+        self._compile_restriction(compiled, restriction_type, members)
+        self.apply_compiled(compiled)
+
+    def _compile_restriction(self, compiled, restriction_type, members):
         # Order members of restriction, so that members look somewhat like this:
         # ([a, b], [b, c], [c], [c, d, e], [e, f])
         for x in range(len(members) - 1):
@@ -420,22 +663,23 @@ class Datastore:
             assert members[x][-1] == members[x + 1][0]
 
         if restriction_type.startswith("no_"):
-            # Start by denoting 'from>via'
-            forbid = "{},{},".format(members[0][-2], members[1][0])
+            # Index by 'from>via', the forbidden move is the following nodes
+            forbid = []
+            forbid_activator = (members[0][-2], members[1][0])
 
             # Add all via members
             for x in range(1, len(members) - 1):
                 for i in members[x][1:]:
-                    forbid += "{},".format(i)
+                    forbid.append(i)
 
             # Finalize by denoting 'via>to'
-            forbid += str(members[-1][1])
+            forbid.append(members[-1][1])
 
-            self.forbiddenMoves[forbid] = True
+            compiled.add_restriction("no", forbid_activator, forbid)
 
         elif restriction_type.startswith("only_"):
             force = []
-            force_activator = "{},{}".format(members[0][-2], members[1][0])
+            force_activator = (members[0][-2], members[1][0])
 
             # Add all via members
             for x in range(1, len(members) - 1):
@@ -445,9 +689,32 @@ class Datastore:
             # Finalize by denoting 'via>to'
             force.append(members[-1][1])
 
-            self.mandatoryMoves[force_activator] = force
+            compiled.add_restriction("only", force_activator, force)
+
+    def next_restriction_state(self, state, node_from, node_to):
+        """Follow forbidden moves along the edge node_from>node_to
+
+        state is the tuple of forbidden moves being followed, each one as the tuple of its remaining nodes
+        (empty tuple at route start). Return the state after the edge, or None if the edge completes
+        a forbidden move."""
+        if not state and (node_from, node_to) not in self.forbiddenMoves:
+            return ()
+
+        next_state = []
+        for remaining in state:
+            if remaining[0] == node_to:
+                if len(remaining) == 1:
+                    return None
+                next_state.append(remaining[1:])
+        next_state.extend(self.forbiddenMoves.get((node_from, node_to), ()))
+        return tuple(next_state)
 
     def store_way(self, tags, nodes):
+        compiled = CompiledTile()
+        self._compile_way(compiled, tags, nodes)
+        self.apply_compiled(compiled)
+
+    def _compile_way(self, compiled, tags, nodes):
         highway = equivalent(tags.get("highway", ""))
         railway = equivalent(tags.get("railway", ""))
         oneway = tags.get("oneway", "")
@@ -470,50 +737,36 @@ class Datastore:
         if (not self._allowed_vehicle(tags)) or weight <= 0:
             return
 
-        # Store routing information
+        # Store routing information, as the travel cost of each edge (its length divided by the weight)
         for index in range(1, len(nodes)):
             node1_id, node1_lat, node1_lon = nodes[index - 1]
             node2_id, node2_lat, node2_lon = nodes[index]
-
-            # Check if nodes' positions are stored
-            if node1_id not in self.rnodes:
-                self.rnodes[node1_id] = (node1_lat, node1_lon)
-            if node2_id not in self.rnodes:
-                self.rnodes[node2_id] = (node2_lat, node2_lon)
-
-            # Check if nodes have dicts for storing travel costs
-            if node1_id not in self.routing:
-                self.routing[node1_id] = {}
-            if node2_id not in self.routing:
-                self.routing[node2_id] = {}
+            cost = distance((node1_lat, node1_lon), (node2_lat, node2_lon)) / weight
+            node1 = compiled.add_node(node1_id, node1_lat, node1_lon)
+            node2 = compiled.add_node(node2_id, node2_lat, node2_lon)
 
             # Is way traversible forward?
             if oneway not in ["-1", "reverse"]:
-                if node1_id not in self.not_update_routing or node2_id not in self.not_update_routing[node1_id]:
-                    self.routing[node1_id][node2_id] = weight
+                compiled.add_edge(node1, node2, cost)
 
             # Is way traversible backword?
             if oneway not in ["yes", "true", "1"]:
-                if node2_id not in self.not_update_routing or node1_id not in self.not_update_routing[node2_id]:
-                    self.routing[node2_id][node1_id] = weight
+                compiled.add_edge(node2, node1, cost)
 
-    def find_node(self, lat, lon):
+    def find_node(self, lat, lon, routable_only=False):
         """Find the nearest node that can be the start of a route"""
+        nodes = self.find_nodes(lat, lon, 1, routable_only)
+        return nodes[0] if nodes else None
+
+    def find_nodes(self, lat, lon, k=1, routable_only=False):
+        """Find the k nearest nodes, optionally only the ones with outgoing routing edges"""
         # Get area around location we're trying to find
         self.get_area(lat, lon)
-        max_dist, closest_node = math.inf, None
-
-        # Iterate over nodes and overwrite closest_node if it's closer
-        for node_id, node_pos in self.rnodes.items():
-
-            distance_diff = distance(node_pos, (lat, lon))
-            if distance_diff < max_dist:
-                max_dist = distance_diff
-                closest_node = node_id
-
-        return closest_node
+        accept = (lambda node_id: bool(self.routing.get(node_id))) if routable_only else None
+        return [node_id for dist, node_id in self.node_index.nearest(lat, lon, k, accept)]
 
     def report(self):
         """Display some info about the loaded data"""
-        print("Loaded %d nodes" % len(list(self.rnodes)))
-        print("Loaded %d %s routes" % (len(list(self.routing)), self.transport))
+        with self.graph_lock:
+            print("Loaded %d nodes" % len(list(self.rnodes)))
+            print("Loaded %d %s routes" % (len(list(self.routing)), self.transport))
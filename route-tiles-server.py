@@ -7,22 +7,50 @@ import re
 import socketserver
 import string
 import struct
+import threading
+import time
 import zlib
 import argparse
+import gzip
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import partial
 from pathlib import Path
 from pprint import pprint
 from urllib import parse
 
-from tilesrouter import RouteServer, latlons_to_gpx
+from activityfilter import FilterError
+from routecache import RouteCache
+from routingpool import RoutingPool, ROUTING_PROCESSES
+from tilesrouter import RouteServer, latlons_to_gpx, TILES_CACHE_DIR
 from tile import tiles_to_kml
 from statshunters import get_statshunters_activities, tiles_from_activities, compute_max_square, compute_cluster, statshunters_path
+from utils import encode_polyline
 
 
 PORT = 8000
+COMPACT_GRAPH = False
+# RoutingPool of the server, without it routes are computed in threads of the server process
+ROUTING_POOL = None
+# Routes already found, shared by the sessions
+ROUTE_CACHE = RouteCache()
 
 sessionDict = {}
+# Requests are served by concurrent threads
+sessionLock = threading.Lock()
+# Expired sessions are looked for at this interval (in s), not at each request
+SESSION_CHECK_INTERVAL = 10
+next_session_check = 0
+# route_events streams are kept open at most STREAM_TIMEOUT s (the browser reconnects),
+# with a comment every KEEPALIVE_INTERVAL s so that closed connections are detected
+STREAM_TIMEOUT = 300
+KEEPALIVE_INTERVAL = 15
+# Routes are sent as encoded polylines, with this number of decimals (0.1m)
+POLYLINE_PRECISION = 6
+# Routes sent to a session kept to compute the next ones as deltas
+SENT_ROUTES = 8
+# Compression level of the answers, for the clients accepting gzip
+GZIP_LEVEL = 6
 chars = string.ascii_letters + string.digits
 
 
@@ -30,14 +58,34 @@ class SessionElement(object):
     """Arbitrary objects, referenced by the session id"""
 
     def __init__(self):
-        self.routeServer = RouteServer()
+        self.routeServer = RouteServer(compact_graph=COMPACT_GRAPH, pool=ROUTING_POOL, cache=ROUTE_CACHE)
         self.last_access = datetime.now()
+        # Route requests of the session are started one at a time
+        self.lock = threading.Lock()
+        # Node ids of the last routes sent to the client, by route id
+        self.sent_routes = OrderedDict()
+        self.sent_routes_lock = threading.Lock()
 
     def refresh(self):
         self.last_access = datetime.now()
 
+    def route_delta(self, route_id, route, new_route_id):
+        """Number of first nodes of route already sent to the client with route route_id,
+        the client will then have route as new_route_id"""
+        with self.sent_routes_lock:
+            sent_route = self.sent_routes.get(route_id)
+            self.sent_routes[new_route_id] = route.route
+            self.sent_routes.move_to_end(new_route_id)
+            while len(self.sent_routes) > SENT_ROUTES:
+                self.sent_routes.popitem(last=False)
+        if sent_route is None:
+            return 0
+        common = min(len(sent_route), len(route.route))
+        return next((i for i in range(common) if sent_route[i] != route.route[i]), common)
+
 
 def check_sessions():
+    """Remove the expired sessions, called with sessionLock held"""
     for session_id in list(sessionDict):
         session = sessionDict[session_id]
         if session.routeServer.is_complete:
@@ -49,7 +97,7 @@ def check_sessions():
             print("Remove session ", session_id)
             if not session.routeServer.is_complete:
                 print("  abort previous routing")
-                session.routeServer.myRouter.abort()
+                session.routeServer.abort()
             sessionDict.pop(session_id)
 
 
@@ -110,7 +158,11 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
         data_folder = Path(__file__).parent.joinpath('data')
         folder = get_statshunters_activities(url, data_folder)
 
-        tiles = tiles_from_activities(folder, filter_str=sh_filter)
+        try:
+            tiles = tiles_from_activities(folder, filter_str=sh_filter)
+        except FilterError as e:
+            self.wfile.write(json.dumps({'status': 'Fail', 'message': str(e)}).encode('utf-8'))
+            return
 
         kml_max_square = compute_max_square(tiles)
         kml_cluster = compute_cluster(tiles)
@@ -133,7 +185,11 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
         data_folder = Path(__file__).parent.joinpath('data')
         folder = statshunters_path(url, data_folder)
 
-        tiles = tiles_from_activities(folder, filter_str=sh_filter)
+        try:
+            tiles = tiles_from_activities(folder, filter_str=sh_filter)
+        except FilterError as e:
+            self.wfile.write(json.dumps({'status': 'Fail', 'message': str(e)}).encode('utf-8'))
+            return
 
         kml_max_square = compute_max_square(tiles)
 
@@ -168,24 +224,23 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
                 wpi += 1
             pprint(waypoints)
 
+        route_id = qs['findRouteId'][0] if 'findRouteId' in qs else None
         answer = {'sessionId': self.sessionId}
 
-        router, message, info = self.session.routeServer.start_route(mode, start, end, tiles, waypoints=waypoints, config={'turnaround_cost':turnaround_cost})
+        with self.session.lock:
+            router, message, info = self.session.routeServer.start_route(mode, start, end, tiles, waypoints=waypoints, config={'turnaround_cost':turnaround_cost})
+            is_complete = self.session.routeServer.is_complete
+            route = self.session.routeServer.route
 
         if router:
             answer['status'] = "OK"
-            if self.session.routeServer.is_complete:
+            if is_complete:
                 answer['state'] = 'complete'
             else:
                 answer['state'] = 'searching'
 
-            route = self.session.routeServer.route
             if route:
-                crc = "{:X}".format(zlib.crc32(struct.pack(">{}Q".format(len(route.route)), *route.route)))
-
-                answer['findRouteId'] = crc
-                answer['length'] = route.length
-                answer['route'] = route.routeLatLons
+                self._add_route(answer, route, route_id)
         else:
             answer['status'] = "Fail"
             answer['message'] = message
@@ -193,34 +248,90 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
 
         self.wfile.write(json.dumps(answer).encode('utf-8'))
 
-    def do_GET_route_status(self):
-        parsed_path = parse.urlparse(self.path)
-        qs = parse.parse_qs(parsed_path.query, keep_blank_values=True)
+    def _add_route(self, answer, route, route_id):
+        """Add route to answer as a delta of the route route_id, the last one received by the client:
+        the number of its first points kept (routeStart) and the next ones as an encoded polyline"""
+        crc = "{:X}".format(zlib.crc32(struct.pack(">{}Q".format(len(route.route)), *route.route)))
+        start = self.session.route_delta(route_id, route, crc)
+        answer['findRouteId'] = crc
+        answer['length'] = route.length
+        answer['routeStart'] = start
+        answer['routePolyline'] = encode_polyline(route.routeLatLons[start:], POLYLINE_PRECISION)
+
+    def _route_status(self, my_router, route_id):
+        """Status of a route search, with its route if it isn't route_id (the one of the client)"""
         answer = {'status': "OK"}
-
-        if self.session.routeServer.myRouter.error_code==0:
-            if self.session.routeServer.is_complete:
+        if my_router is None:
+            answer['state'] = 'searching'
+            answer['progress'] = 0.0
+        elif my_router.error_code==0:
+            is_complete = my_router.is_complete
+            if is_complete:
                 answer['state'] = 'complete'
             else:
                 answer['state'] = 'searching'
-            answer['progress'] = self.session.routeServer.progress
-            route = self.session.routeServer.route
+            answer['progress'] = my_router.progress
+            route = my_router.min_route
             if route:
                 crc = "{:X}".format(zlib.crc32(struct.pack(">{}Q".format(len(route.route)), *route.route)))
 
-                if self.session.routeServer.is_complete or 'findRouteId' not in qs or crc != qs['findRouteId'][0]:
-                    answer['findRouteId'] = crc
-                    answer['length'] = route.length
-                    answer['route'] = route.routeLatLons
+                if is_complete or crc != route_id:
+                    self._add_route(answer, route, route_id)
         else:
             answer['status'] = 'Fail'
-            answer['error_code'] = self.session.routeServer.myRouter.error_code
-            answer['error_args'] =self.session.routeServer.myRouter.error_args
-
+            answer['error_code'] = my_router.error_code
+            answer['error_args'] = my_router.error_args
 
         answer['sessionId'] = self.sessionId
+        return answer
+
+    def do_GET_route_status(self):
+        parsed_path = parse.urlparse(self.path)
+        qs = parse.parse_qs(parsed_path.query, keep_blank_values=True)
+        route_id = qs['findRouteId'][0] if 'findRouteId' in qs else None
+
+        # The router can be replaced by a start_route of the session meanwhile
+        my_router = self.session.routeServer.myRouter
+        answer = self._route_status(my_router, route_id)
         self.wfile.write(json.dumps(answer).encode('utf-8'))
 
+    def do_STREAM_route_events(self):
+        """route_status as server-sent events: an event each time the progress or the route changes,
+        until the search is over"""
+        parsed_path = parse.urlparse(self.path)
+        qs = parse.parse_qs(parsed_path.query, keep_blank_values=True)
+        route_id = qs['findRouteId'][0] if 'findRouteId' in qs else None
+
+        my_router = self.session.routeServer.myRouter
+        end_time = time.monotonic() + STREAM_TIMEOUT
+        version = None
+        last_event = None
+        try:
+            self.wfile.write(b"retry: 1000\n\n")
+            while my_router is not None and time.monotonic() < end_time:
+                new_version = my_router.updates.wait(version, KEEPALIVE_INTERVAL)
+                if new_version == version:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                version = new_version
+                answer = self._route_status(my_router, route_id)
+                answer['progress'] = round(answer.get('progress', 0.0), 1)
+                event = (answer['status'], answer.get('state'), answer['progress'], answer.get('findRouteId', route_id))
+                if event != last_event:
+                    self.wfile.write("data: {}\n\n".format(json.dumps(answer)).encode('utf-8'))
+                    self.wfile.flush()
+                    last_event = event
+                    route_id = answer.get('findRouteId', route_id)
+                if answer['status'] != "OK" or answer['state'] == 'complete':
+                    break
+                # A new route has been requested by the session, its client opens a new stream
+                if self.session.routeServer.myRouter is not my_router:
+                    break
+                self.session.refresh()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
     def do_GET_generate_gpx(self):
         parsed_path = parse.urlparse(self.path)
         qs = parse.parse_qs(parsed_path.query, keep_blank_values=True)
@@ -269,21 +380,47 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
             answer = {'status': "Fail", 'message': "error generating KML"}
         self.wfile.write(json.dumps(answer).encode('utf-8'))
 
-    def _set_headers(self):
+    def _set_headers(self, content_type='application/json', compress=False, cache=True):
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        if not cache:
+            self.send_header('Cache-Control', 'no-cache')
         self.end_headers()
 
+    def _send_answer(self, method, compress):
+        """Call method, writing the answer, compressed with gzip if compress"""
+        if not compress:
+            method()
+            return
+        wfile = self.wfile
+        # Its flush() sends what has been written (for the streams)
+        self.wfile = gzip.GzipFile(fileobj=wfile, mode='wb', compresslevel=GZIP_LEVEL)
+        try:
+            method()
+        finally:
+            try:
+                self.wfile.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            self.wfile = wfile
+
     def do_GET(self):
         print(self.path)
         parsed_path = parse.urlparse(self.path)
 
         get_action_name = 'do_GET_' + parsed_path.path[1:]
-        if hasattr(self, get_action_name):
+        stream_action_name = 'do_STREAM_' + parsed_path.path[1:]
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if hasattr(self, stream_action_name):
             self.session = self.get_session()
-            self._set_headers()
-            method = getattr(self, get_action_name)
-            method()
+            self._set_headers('text/event-stream', compress=compress, cache=False)
+            self._send_answer(getattr(self, stream_action_name), compress)
+        elif hasattr(self, get_action_name):
+            self.session = self.get_session()
+            self._set_headers(compress=compress)
+            self._send_answer(getattr(self, get_action_name), compress)
         else:
             super().do_GET()
 
@@ -355,6 +492,7 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
         return None, "Unexpected ends of data."
 
     def get_session(self):
+        global next_session_check
 
         parsed_path = parse.urlparse(self.path)
         qs = parse.parse_qs(parsed_path.query, keep_blank_values=True)
@@ -362,25 +500,34 @@ class RouteHttpServer(http.server.SimpleHTTPRequestHandler):
             self.sessionId = qs["sessionId"][0]
         else:
             self.sessionId = generate_random(8)
-        try:
-            session_object = sessionDict[self.sessionId]
-        except KeyError:
-            self.sessionId = generate_random(8)
-            session_object = SessionElement()
-            sessionDict[self.sessionId] = session_object
-            print("Create session", self.sessionId)
-
-        session_object.refresh()
-        check_sessions()
+        with sessionLock:
+            try:
+                session_object = sessionDict[self.sessionId]
+            except KeyError:
+                self.sessionId = generate_random(8)
+                session_object = SessionElement()
+                sessionDict[self.sessionId] = session_object
+                print("Create session", self.sessionId)
+
+            session_object.refresh()
+            if time.monotonic() >= next_session_check:
+                next_session_check = time.monotonic() + SESSION_CHECK_INTERVAL
+                check_sessions()
         return session_object
 
 
+class RouteTilesServer(socketserver.ThreadingTCPServer):
+    """Serve each request in its own thread, so that a slow request (statshunters download,
+    tiles loading of start_route) doesn't block the route_status polling of the other users"""
+    daemon_threads = True
+
+
 def route_tiles_server(port):
     # Create gpx folder is not exists for gpx export
     Path(__file__).parent.joinpath('static', 'gpx').mkdir(exist_ok=True)
     Path(__file__).parent.joinpath('debug').mkdir(exist_ok=True)
     handler_class = partial(RouteHttpServer, directory=str(Path(__file__).parent.joinpath('static')))
-    with socketserver.TCPServer(("", port), handler_class) as httpd:
+    with RouteTilesServer(("", port), handler_class) as httpd:
         print("serving at port", port)
         httpd.serve_forever()
 
@@ -388,8 +535,20 @@ def route_tiles_server(port):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Route Tiles server')
     parser.add_argument('-p', '--port', dest="port", type=int, default=PORT, help="Server port")
+    parser.add_argument('--compact-graph', dest="compact_graph", action='store_true',
+                        help="Store routing graphs in arrays (less memory, a bit slower)")
+    parser.add_argument('--routing-processes', dest="routing_processes", type=int, default=ROUTING_PROCESSES,
+                        help="Processes computing the routes (0: in threads of the server process)")
+    parser.add_argument('--persist-routes', dest="persist_routes", action='store_true',
+                        help="Keep the routes already found on disk, for the next runs")
     args = parser.parse_args()
 
+    COMPACT_GRAPH = vars(args)['compact_graph']
+    if args.routing_processes > 0:
+        ROUTING_POOL = RoutingPool(args.routing_processes)
+    if args.persist_routes:
+        ROUTE_CACHE = RouteCache(os.path.join(TILES_CACHE_DIR, 'routes'))
+
     port = vars(args)['port']
 
     route_tiles_server(port)
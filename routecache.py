@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from compiledtile import profile_signature
+from pyroutelib3 import TYPES
+from tileloader import route_tiles
+
+# Change it when the search changes the routes found
+CACHE_VERSION = 1
+# Routes kept in memory, at most MAX_ROUTES and MAX_POINTS points for all of them
+MAX_ROUTES = 256
+MAX_POINTS = 500000
+# Route files kept on disk
+MAX_FILES = 10000
+
+
+def data_version(cache_dir, tiles):
+    """Modification times of the tiles cache files of OSM tiles (x, y, z), None for the missing ones"""
+    version = []
+    for x, y, z in tiles:
+        try:
+            version.append(os.stat(os.path.join(cache_dir, str(z), str(x), str(y), "data.osm")).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return version
+
+
+def route_key(mode, start_loc, end_loc, tiles, waypoints, config, cache_dir):
+    """Hash of a route request and of the OSM data around it: same key, same route"""
+    # Tiles and waypoints are a set of zones to visit, their order doesn't matter
+    tiles = sorted(tiles, key=str)
+    waypoints = sorted([round(v, 6) for v in wp] for wp in waypoints)
+    request = {
+        "version": CACHE_VERSION,
+        "mode": mode,
+        "profile": profile_signature(TYPES[mode]) if mode in TYPES else None,
+        "start": [round(v, 6) for v in start_loc],
+        "end": [round(v, 6) for v in end_loc],
+        "tiles": tiles,
+        "waypoints": waypoints,
+        "config": config,
+        "data": data_version(cache_dir, route_tiles(start_loc, end_loc, tiles, waypoints)),
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class RouteCache(object):
+    """Routes already found, by route_key, as {"route": node ids, "latlons": [[lat, lon]], "length": km}
+
+    The last used routes are kept in memory, all of them in files of directory if given
+    (the least recently used files are removed above MAX_FILES)."""
+
+    def __init__(self, directory=None, max_routes=MAX_ROUTES, max_points=MAX_POINTS, max_files=MAX_FILES):
+        self.directory = directory
+        self.max_routes = max_routes
+        self.max_points = max_points
+        self.max_files = max_files
+        self._routes = OrderedDict()
+        self._points = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Stored route of a key, None if there is none"""
+        with self._lock:
+            route = self._routes.get(key)
+            if route is not None:
+                self._routes.move_to_end(key)
+                return route
+        if not self.directory:
+            return None
+
+        try:
+            with open(self._filename(key), encoding="utf-8") as hf:
+                route = json.load(hf)
+            # Keep it as recently used
+            os.utime(self._filename(key))
+        except (OSError, ValueError):
+            return None
+        self._add(key, route)
+        return route
+
+    def put(self, key, route):
+        """Store the route of a key"""
+        self._add(key, route)
+        if not self.directory:
+            return
+        tmp_filename = "{}.{}.{}.tmp".format(self._filename(key), os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_filename, "w", encoding="utf-8") as hf:
+                json.dump(route, hf)
+            os.replace(tmp_filename, self._filename(key))
+            self._prune_files()
+        except OSError:
+            pass
+
+    def _add(self, key, route):
+        with self._lock:
+            if key in self._routes:
+                self._points -= len(self._routes.pop(key)["route"])
+            self._routes[key] = route
+            self._points += len(route["route"])
+            while len(self._routes) > 1 and (len(self._routes) > self.max_routes or self._points > self.max_points):
+                key, route = self._routes.popitem(last=False)
+                self._points -= len(route["route"])
+
+    def _prune_files(self):
+        """Remove the least recently used files above max_files, down to 90% of it"""
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in files[:len(files) - self.max_files * 9 // 10]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import tileloader
+from tilesrouter import ERR_NO, ERR_ABORT_REQUEST, ERR_ROUTE_ERROR, RouteUpdates, create_router
+
+# Processes computing the routes
+ROUTING_PROCESSES = os.cpu_count() or 1
+# Jobs waiting for a worker, more are refused
+MAX_QUEUED_JOBS = 8
+# Progress and partial route are sent back to the server at this interval (in s)
+REPORT_INTERVAL = 0.5
+# Dead workers (or server, from the workers) are looked for at this interval (in s)
+CHECK_INTERVAL = 1.0
+
+
+class JobCancel(object):
+    """Cancellation flag of a job, in memory shared by the server and the workers (as a threading.Event)"""
+
+    def __init__(self, flags, slot):
+        self.flags = flags
+        self.slot = slot
+
+    def is_set(self):
+        return bool(self.flags[self.slot])
+
+    def set(self):
+        self.flags[self.slot] = 1
+
+
+def _report(my_router, job_id, results, done):
+    """Send the progress and the last minimal route of a search, until it is done"""
+    last_route = None
+    while not done.wait(REPORT_INTERVAL):
+        route = my_router.min_route
+        results.put(("progress", job_id, my_router.progress, route if route is not last_route else None))
+        last_route = route
+
+
+def _worker(jobs, results, cancel_flags, server_pid):
+    """Route searches of a worker process
+
+    The Datastores of the modes already routed stay loaded for the next jobs."""
+    # The routing workers use all the cores, tiles are parsed in their threads
+    tileloader.PARSE_PROCESSES = 0
+    while True:
+        try:
+            job = jobs.get(timeout=CHECK_INTERVAL)
+        except queue.Empty:
+            # The server has been killed
+            if os.getppid() != server_pid:
+                return
+            continue
+        job_id, slot, args = job
+        results.put(("start", job_id, os.getpid()))
+        cancel = JobCancel(cancel_flags, slot)
+        if cancel.is_set():
+            results.put(("done", job_id, ERR_ABORT_REQUEST, "", None))
+            continue
+
+        try:
+            my_router = create_router(*args, cancel=cancel)
+            done = threading.Event()
+            reporter = threading.Thread(target=_report, args=(my_router, job_id, results, done), daemon=True)
+            reporter.start()
+            try:
+                my_router.run()
+            finally:
+                done.set()
+                reporter.join()
+            results.put(("done", job_id, my_router.error_code, my_router.error_args, my_router.min_route))
+        except Exception:
+            traceback.print_exc()
+            results.put(("done", job_id, ERR_ROUTE_ERROR, "", None))
+
+
+class RouteJob(object):
+    """Route search of a RoutingPool, seen by the server as its MyRouter"""
+
+    def __init__(self, pool, job_id, slot):
+        self.pool = pool
+        self.job_id = job_id
+        self.slot = slot
+        # pid of the worker process computing it
+        self.worker = None
+        self.progress = 0.0
+        self.min_route = None
+        self.error_code = ERR_NO
+        self.error_args = ""
+        self._complete = False
+        self.updates = RouteUpdates()
+        # Called with the job when it is done
+        self.on_done = None
+
+    @property
+    def is_complete(self):
+        return self._complete
+
+    def abort(self):
+        self.pool.cancel(self)
+
+    def generate_gpx(self, file_name, gpx_name):
+        if self.min_route:
+            return self.min_route.to_gpx(file_name, gpx_name)
+        else:
+            return False
+
+
+class RoutingPool(object):
+    """Worker processes computing the routes, so that searches run on all the cores
+    and don't slow down the server threads
+
+    Each job has a slot, with its cancellation flag: there are as many slots as workers
+    plus queued jobs, a job is refused when there is no free slot."""
+
+    def __init__(self, processes=ROUTING_PROCESSES, max_queued=MAX_QUEUED_JOBS):
+        # spawn: the server process has threads, it is not safe to fork it
+        self._context = multiprocessing.get_context("spawn")
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self.cancel_flags = self._context.RawArray('b', processes + max_queued)
+        self._free_slots = list(range(processes + max_queued))
+        # Jobs queued or running, by job id
+        self._running = {}
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._workers = [self._start_worker() for _ in range(processes)]
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _start_worker(self):
+        worker = self._context.Process(target=_worker, args=(self._jobs, self._results, self.cancel_flags, os.getpid()),
+                                       daemon=True)
+        worker.start()
+        return worker
+
+    def submit(self, mode, start_loc, end_loc, tiles, waypoints, config, compact_graph=False, on_done=None):
+        """Queue a route search, return its RouteJob, or None if too many jobs are waiting"""
+        with self._lock:
+            if not self._free_slots:
+                return None
+            job = RouteJob(self, next(self._job_ids), self._free_slots.pop())
+            job.on_done = on_done
+            self.cancel_flags[job.slot] = 0
+            self._running[job.job_id] = job
+        args = (mode, start_loc, end_loc, tiles, list(waypoints), config, compact_graph)
+        self._jobs.put((job.job_id, job.slot, args))
+        return job
+
+    def cancel(self, job):
+        """Cancel a job, if it isn't done (its slot may be used by another job)"""
+        with self._lock:
+            if job.job_id in self._running:
+                self.cancel_flags[job.slot] = 1
+
+    def _collect(self):
+        """Update the jobs with the messages of the workers"""
+        next_check = time.monotonic() + CHECK_INTERVAL
+        while True:
+            try:
+                message = self._results.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                message = None
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + CHECK_INTERVAL
+            if message is None:
+                continue
+
+            kind, job_id = message[:2]
+            job = self._running.get(job_id)
+            if job is None:
+                continue
+            if kind == "start":
+                job.worker = message[2]
+            elif kind == "progress":
+                job.progress = message[2]
+                if message[3] is not None:
+                    job.min_route = message[3]
+                job.updates.notify()
+            else:
+                self._finish(job, *message[2:])
+
+    def _finish(self, job, error_code, error_args, route):
+        job.error_code = error_code
+        job.error_args = error_args
+        if route is not None:
+            job.min_route = route
+        job.progress = 100.0
+        job._complete = True
+        job.updates.notify()
+        with self._lock:
+            if self._running.pop(job.job_id, None) is not None:
+                self._free_slots.append(job.slot)
+        if job.on_done is not None:
+            try:
+                job.on_done(job)
+            except Exception:
+                traceback.print_exc()
+
+    def _check_workers(self):
+        """Replace the dead workers, their job fails"""
+        for i, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            print("Routing worker {} died".format(worker.pid))
+            for job in list(self._running.values()):
+                if job.worker == worker.pid:
+                    self._finish(job, ERR_ROUTE_ERROR, "", None)
+            self._workers[i] = self._start_worker()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import math
+from array import array
+
+import numpy as np
+
+from utils import distance_array
+
+# Nodes are bucketed by zoom 15 tile (about 1km wide)
+ZOOM = 15
+EARTH_RADIUS = 6371
+
+
+def _tile_xy(lat, lon):
+    n = 2 ** ZOOM
+    lat_r = math.radians(lat)
+    x = math.floor(n * (lon + 180) / 360)
+    y = math.floor(n * (1 - math.log(math.tan(lat_r) + 1 / math.cos(lat_r)) / math.pi) / 2)
+    return x, y
+
+
+def _tile_lon(x):
+    return x / 2 ** ZOOM * 360 - 180
+
+
+def _tile_lat(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2 ** ZOOM))))
+
+
+def _bucket_arrays(bucket):
+    """Copies of the arrays of a bucket (ids, lats, lons, sequence numbers)
+
+    The bucket can be appended by another thread: its arrays are copied, not viewed,
+    and cut to the length of the last appended one."""
+    count = len(bucket[3])
+    return (np.array(bucket[0], dtype=np.int64)[:count], np.array(bucket[1], dtype=float)[:count],
+            np.array(bucket[2], dtype=float)[:count], np.array(bucket[3], dtype=np.int64)[:count])
+
+
+def _meridian_distance(lat, delta_lon):
+    """Shortest distance in km from a point to a meridian delta_lon degrees away"""
+    if abs(delta_lon) >= 90:
+        return math.inf
+    return EARTH_RADIUS * math.asin(abs(math.sin(math.radians(delta_lon))) * math.cos(math.radians(lat)))
+
+
+class GridIndex(object):
+    """Spatial index of nodes, in buckets of zoom 15 tiles
+
+    Nearest nodes are searched in square rings of tiles around the point, until the next ring
+    can't be closer than the nodes already found."""
+
+    def __init__(self):
+        # (x, y) -> (node ids, lats, lons, insertion sequence numbers)
+        self.buckets = {}
+        self.bounds = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, node_id, lat, lon):
+        x, y = _tile_xy(lat, lon)
+        bucket = self.buckets.get((x, y))
+        if bucket is None:
+            bucket = self.buckets[(x, y)] = (array('q'), array('d'), array('d'), array('q'))
+            if self.bounds is None:
+                self.bounds = (x, y, x, y)
+            else:
+                min_x, min_y, max_x, max_y = self.bounds
+                self.bounds = (min(min_x, x), min(min_y, y), max(max_x, x), max(max_y, y))
+        bucket[0].append(node_id)
+        bucket[1].append(lat)
+        bucket[2].append(lon)
+        bucket[3].append(self.count)
+        self.count += 1
+
+    def _ring(self, x, y, ring):
+        """Tiles at the border of the square of side 2 * ring + 1 around x, y"""
+        if ring == 0:
+            return [(x, y)]
+        cells = [(x + dx, y + dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)]
+        cells += [(x + dx, y + dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+        return cells
+
+    def _outside_distance(self, lat, lon, x, y, ring):
+        """Lower bound of the distance from lat, lon to any point outside the square of rings 0..ring"""
+        return min(EARTH_RADIUS * math.radians(_tile_lat(y - ring) - lat),
+                   EARTH_RADIUS * math.radians(lat - _tile_lat(y + ring + 1)),
+                   _meridian_distance(lat, lon - _tile_lon(x - ring)),
+                   _meridian_distance(lat, _tile_lon(x + ring + 1) - lon))
+
+    def nearest(self, lat, lon, k=1, accept=None):
+        """Return the k nearest nodes of lat, lon, as a sorted list of (distance in km, node id)
+
+        If given, accept(node_id) filters the nodes that can be returned."""
+        if self.bounds is None:
+            return []
+        x, y = _tile_xy(lat, lon)
+        min_x, min_y, max_x, max_y = self.bounds
+        max_ring = max(x - min_x, max_x - x, y - min_y, max_y - y)
+
+        found = []  # heap of (-distance, node id), the k best
+        for ring in range(max_ring + 1):
+            for cell in self._ring(x, y, ring):
+                bucket = self.buckets.get(cell)
+                if bucket is None:
+                    continue
+                ids, lats, lons, sequence = _bucket_arrays(bucket)
+                dists = distance_array((lat, lon), lats, lons)
+                for i in np.argsort(dists):
+                    dist = float(dists[i])
+                    if len(found) == k and dist >= -found[0][0]:
+                        break
+                    node_id = int(ids[i])
+                    if accept is not None and not accept(node_id):
+                        continue
+                    if len(found) == k:
+                        heapq.heapreplace(found, (-dist, node_id))
+                    else:
+                        heapq.heappush(found, (-dist, node_id))
+            if len(found) == k and -found[0][0] <= self._outside_distance(lat, lon, x, y, ring):
+                break
+
+        return sorted((-dist, node_id) for dist, node_id in found)
+
+    def within(self, lat, lon, radius):
+        """Return the ids of the nodes at most radius km from lat, lon, in their insertion order"""
+        delta_lat = math.degrees(radius / EARTH_RADIUS)
+        delta_lon = delta_lat / max(math.cos(math.radians(lat)), 1e-6)
+        min_x, min_y = _tile_xy(min(lat + delta_lat, 85), lon - delta_lon)
+        max_x, max_y = _tile_xy(max(lat - delta_lat, -85), lon + delta_lon)
+
+        sequences, ids = [], []
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                bucket = self.buckets.get((x, y))
+                if bucket is None:
+                    continue
+                bucket_ids, lats, lons, sequence = _bucket_arrays(bucket)
+                inside = np.flatnonzero(distance_array((lat, lon), lats, lons) <= radius)
+                ids.append(bucket_ids[inside])
+                sequences.append(sequence[inside])
+        if not ids:
+            return []
+        ids, sequences = np.concatenate(ids), np.concatenate(sequences)
+        return ids[np.argsort(sequences)].tolist()
@@ -238,13 +238,38 @@ $(document).ready(function(){
         function latlonToQuery(ll) {
           return  [ll.lat, ll.lng];
         }
+        function decodePolyline(str, precision) {
+          // [lat, lon] list of an encoded polyline (Google polyline algorithm)
+          let factor = Math.pow(10, precision);
+          let latlons = [];
+          let index = 0, lat = 0, lon = 0;
+          while (index < str.length) {
+            let deltas = [0, 0];
+            for (let k=0; k<2; k++) {
+              let shift = 0, result = 0, byte;
+              do {
+                byte = str.charCodeAt(index++) - 63;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+              } while (byte >= 0x20);
+              deltas[k] = (result & 1) ? ~(result >> 1) : (result >> 1);
+            }
+            lat += deltas[0];
+            lon += deltas[1];
+            latlons.push([lat / factor, lon / factor]);
+          }
+          return latlons;
+        }
 
         var routeId="";
+        // Points of the route routeId, the server sends the next routes as deltas of it
+        var routeLatLons = [];
         var timeoutID=false;
         var active_timeout = 0;
         var route_rq_id = 0;
         var sessionId = false;
         var state = false;
+        var routeEvents = false;
 
         function setMessageAlert(level) {
             $("#progress-message").removeClass(function(index, className){
@@ -252,51 +277,93 @@ $(document).ready(function(){
             }).addClass('alert-'+level);
         }
 
+        function show_route_status(data) {
+            // Display a route status, return true when the search is over
+            if (data['status']=="OK") {
+                state = data['state']
+                $("#message").text($.i18n("message-state-"+data['state']));
+                if ('routePolyline' in data) {
+                    routeId = data['findRouteId']
+                    routeLatLons = routeLatLons.slice(0, data.routeStart).concat(decodePolyline(data.routePolyline, 6));
+                    if (!routePolyline) {
+                        routePolyline = L.polyline(routeLatLons, {color: '#FF0000', opacity:0.8}).addTo(mymap);
+                    } else {
+                        routePolyline.setLatLngs(routeLatLons).bringToFront();
+                    }
+                    $("#length").text(parseFloat(data['length']).toFixed(2)+" km");
+                }
+                if (data['state']!='complete') {
+                    return false;
+                }
+                setMessageAlert('success');
+                $("#spinner-searching").hide();
+                $("#button-download-route").show();
+                timeoutID = false;
+                actualTrace =  {distance: data.length, route: routeLatLons, polyline: routePolyline};
+                $('button#addTrace').prop("disabled", false);
+            } else {
+                $("#message").text($.i18n("message-state-fail")+":"+$.i18n("msg-error_"+data['error_code']));
+                setMessageAlert('danger');
+                $("#length").text("");
+                error_tiles = data.error_args;
+                for (let i=0; i<error_tiles.length; i++) {
+                    let tile = displayed_tiles.get(error_tiles[i])
+                    tile.error(1);
+                }
+                $("#spinner-searching").hide();
+                timeoutID = false;
+            }
+            return true;
+        };
+
         function route_status(timeout_id) {
             if (timeout_id != active_timeout) return;
             $.getJSON({
                 url: 'route_status',
                 data: { 'sessionId': sessionId, 'findRouteId' : routeId },
                 success: function ( data ) {
-                    if (data['status']=="OK") {
-                        state = data['state']
-                        $("#message").text($.i18n("message-state-"+data['state']));
-                        if ('route' in data) {
-                            routeId = data['findRouteId']
-                            if (!routePolyline) {
-                                routePolyline = L.polyline(data.route, {color: '#FF0000', opacity:0.8}).addTo(mymap);
-                            } else {
-                                routePolyline.setLatLngs(data.route).bringToFront();
-                            }
-                            $("#length").text(parseFloat(data['length']).toFixed(2)+" km");
-                        }
-                        if (data['state']!='complete') {
-                            timeoutID = window.setTimeout(route_status, 1000, ++active_timeout);
-                        } else {
-                            setMessageAlert('success');
-                            $("#spinner-searching").hide();
-                            $("#button-download-route").show();
-                            timeoutID = false;
-                            actualTrace =  {distance: data.length, route: data.route, polyline: routePolyline};
-                            $('button#addTrace').prop("disabled", false);
-                        }
-                    } else {
-                        $("#message").text($.i18n("message-state-fail")+":"+$.i18n("msg-error_"+data['error_code']));
-                        setMessageAlert('danger');
-                        $("#length").text("");
-                        error_tiles = data.error_args;
-                        for (let i=0; i<error_tiles.length; i++) {
-                            let tile = displayed_tiles.get(error_tiles[i])
-                            tile.error(1);
-                        }
-                        $("#spinner-searching").hide();
-                        timeoutID = false;
+                    if (!show_route_status(data)) {
+                        timeoutID = window.setTimeout(route_status, 1000, ++active_timeout);
                     }
-
                 }
             });
         };
 
+        function close_route_events() {
+            if (routeEvents) {
+                routeEvents.close();
+                routeEvents = false;
+            }
+        }
+
+        function route_events(timeout_id) {
+            // Route status sent by the server when it changes, polled if the browser can't
+            if (timeout_id != active_timeout) return;
+            if (!window.EventSource) {
+                route_status(timeout_id);
+                return;
+            }
+            close_route_events();
+            let received = false;
+            routeEvents = new EventSource('route_events?' + $.param({ 'sessionId': sessionId, 'findRouteId' : routeId }));
+            routeEvents.onmessage = function(event) {
+                received = true;
+                if (timeout_id != active_timeout || show_route_status(JSON.parse(event.data))) {
+                    close_route_events();
+                }
+            };
+            routeEvents.onerror = function() {
+                // Reopened with the last route received (the routes are sent as deltas of it),
+                // polled if the stream can't be opened
+                close_route_events();
+                if (received) {
+                    timeoutID = window.setTimeout(route_events, 1000, timeout_id);
+                } else {
+                    route_status(timeout_id);
+                }
+            };
+        };
+
         { // CONFIG-STORAGE
             $('select.config-storage').each(function(){
                 let id = this.id;
@@ -373,7 +440,7 @@ $(document).ready(function(){
                             tile.error(0);
                         }
                         error_tiles = []
-                        route_status(timeout_id);
+                        route_events(timeout_id);
                     } else {
                         setMessageAlert('danger');
                         $("#message").text($.i18n("message-state-fail")+":"+data['message']);
@@ -396,6 +463,7 @@ $(document).ready(function(){
                 window.clearTimeout(timeoutID);
                 timeoutID = false;
             }
+            close_route_events();
             if (!('start' in markers)) return;
             if (!('end' in markers) && selected_tiles.length==0 && waypoints.length==0) return;
             setMessageAlert('info');
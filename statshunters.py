@@ -1,18 +1,29 @@
 import argparse
-import os
+import gzip
+import http.client
 import json
-from urllib.request import urlretrieve
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, urlsplit
+
+from activityfilter import compile_filter
+from activityindex import activity_index
 from utils import retry
 from pathlib import Path
-from tile import Tile
+from tile import coord_from_tile
 import re
+import numpy as np
+from shapely.geometry import Polygon
 from shapely.ops import unary_union
 from fastkml import kml
 
-
-@retry(Exception, tries=6, delay=60, backoff=2)
-def myurlretrieve(url, filename=None, reporthook=None, data=None):
-    return urlretrieve(url, filename, reporthook, data)
+# Activities pages downloaded at the same time
+DOWNLOAD_THREADS = 4
+HTTP_TIMEOUT = 60
+MAX_REDIRECTS = 3
+# ETag, Last-Modified and activities count of the pages downloaded, in the activities folder
+PAGES_META = "pages.meta"
 
 
 def statshunters_path(sharelink_url, folder):
@@ -22,6 +33,130 @@ def statshunters_path(sharelink_url, folder):
     return activities_path
 
 
+class PagesDownloader(object):
+    """Download of the activities pages of a statshunters sharelink
+
+    Pages are downloaded by DOWNLOAD_THREADS threads, each one keeping its HTTP connections
+    open for its next pages. A page already downloaded is asked with its ETag and Last-Modified
+    date: it isn't downloaded again if it hasn't changed."""
+
+    def __init__(self, sharelink_url, activities_path, threads=DOWNLOAD_THREADS):
+        self.sharelink_url = sharelink_url
+        self.activities_path = Path(activities_path)
+        self.threads = threads
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        try:
+            with open(self.activities_path.joinpath(PAGES_META)) as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            self.meta = {}
+
+    def page_path(self, page):
+        return self.activities_path.joinpath("activities_{}.json".format(page))
+
+    def _connection(self, scheme, netloc):
+        """HTTP connection of the thread to a server, opened at its first use"""
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connection = connections[(scheme, netloc)] = connection_class(netloc, timeout=HTTP_TIMEOUT)
+        return connection
+
+    def _get(self, url, headers):
+        """Send a GET request, return the response and its (decompressed) content"""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            connection = self._connection(parts.scheme, parts.netloc)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            try:
+                connection.request('GET', path, headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                # Closed by the server meanwhile: reopened by the next request
+                connection.close()
+                raise
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.getheader('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+            return response, content
+        raise OSError("Too many redirections for {}".format(url))
+
+    @retry((OSError, http.client.HTTPException, ValueError), tries=4, delay=5, backoff=2)
+    def fetch_page(self, page):
+        """Download a page if it has changed, return its number of activities"""
+        filepath = self.page_path(page)
+        url = self.sharelink_url + "/api/activities?page={0}".format(page)
+        with self._lock:
+            meta = self.meta.get(str(page))
+        headers = {}
+        if meta and filepath.exists():
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        print("Get page {} ({})".format(page, url))
+        response, content = self._get(url, headers)
+        if response.status == 304:
+            return meta['activities']
+        if response.status != 200:
+            raise OSError("HTTP error {} for {}".format(response.status, url))
+
+        count = len(json.loads(content)['activities'])
+        tmp_filepath = "{}.{}.tmp".format(filepath, threading.get_ident())
+        with open(tmp_filepath, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_filepath, filepath)
+        with self._lock:
+            self.meta[str(page)] = {'etag': response.getheader('ETag'),
+                                    'last_modified': response.getheader('Last-Modified'), 'activities': count}
+        return count
+
+    def download(self, first_page=1):
+        """Download the pages from first_page, up to the first empty one
+
+        The pages after it, from a previous download, are removed."""
+        end_page = None
+        try:
+            with ThreadPoolExecutor(self.threads) as executor:
+                pending = {}
+                next_page = first_page
+                while True:
+                    while len(pending) < self.threads and (end_page is None or next_page < end_page):
+                        pending[executor.submit(self.fetch_page, next_page)] = next_page
+                        next_page += 1
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page = pending.pop(future)
+                        if future.result() == 0 and (end_page is None or page < end_page):
+                            end_page = page
+        finally:
+            if end_page is not None:
+                self._remove_pages(end_page + 1)
+            self._save_meta()
+
+    def _remove_pages(self, first_page):
+        for filepath in self.activities_path.glob("activities_*.json"):
+            page = filepath.stem.split('_')[-1]
+            if page.isdigit() and int(page) >= first_page:
+                filepath.unlink()
+                self.meta.pop(page, None)
+
+    def _save_meta(self):
+        filepath = self.activities_path.joinpath(PAGES_META)
+        tmp_filepath = "{}.{}.tmp".format(filepath, threading.get_ident())
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_filepath, filepath)
+
+
 def get_statshunters_activities(sharelink_url, folder, full=False):
     activities_path = statshunters_path(sharelink_url, folder)
     page = 1
@@ -30,38 +165,19 @@ def get_statshunters_activities(sharelink_url, folder, full=False):
         while activities_path.joinpath("activities_{}.json".format(page + 2)).exists():
             page += 1
 
-    while True:
-        filepath = activities_path.joinpath("activities_{}.json".format(page))
-        url = sharelink_url + "/api/activities?page={0}".format(page)
-        print("Get page {} ({})".format(page, url))
-        myurlretrieve(url, filepath)
-        with open(filepath) as f:
-            d = json.load(f)
-            if len(d['activities']) == 0:
-                break
-        page += 1
+    PagesDownloader(sharelink_url, activities_path).download(page)
 
+    # Index the pages downloaded
+    activity_index(activities_path)
     return activities_path
 
 
 def tiles_from_activities(activities_dir, filter_str=None):
-    # Get tiles from activities files from statshunters
-    directory = os.fsencode(activities_dir)
-    tiles = []
-
-    for file in os.listdir(directory):
-        filename = os.fsdecode(file)
-        if filename.endswith(".json"):
-            with open(os.path.join(activities_dir, filename)) as f:
-                d = json.load(f)
-                for activity in d['activities']:
-                    if filter_str and not eval(filter_str, globals(),activity):
-                        continue
-                    for tile in activity['tiles']:
-                        uid = "{0}_{1}".format(tile['x'], tile['y'])
-                        if uid not in tiles:
-                            tiles.append(uid)
-    return frozenset(tiles)
+    # Get tiles from activities files from statshunters, through their index
+    index = activity_index(activities_dir)
+    if not filter_str or not filter_str.strip():
+        return index.tiles()
+    return index.tiles(compile_filter(filter_str)(index.table))
 
 
 def getKmlFromGeom(geom):
@@ -94,86 +210,172 @@ def getKmlFromGeom(geom):
     return k.to_string()
 
 
-def compute_zones(tiles):
-    tiles = set(tiles)
-    clusters = []
+def tiles_xy(tiles):
+    """x and y arrays of tiles given as "x_y" strings or (x, y) tuples"""
+    if all(isinstance(t, str) for t in tiles):
+        xy = np.fromstring(' '.join(tiles).replace('_', ' '), dtype=np.int64, sep=' ').reshape(-1, 2)
+    else:
+        xy = np.array([t.split('_') if isinstance(t, str) else t for t in tiles], dtype=np.int64).reshape(-1, 2)
+    return xy[:, 0], xy[:, 1]
+
+
+def _grid_indexes(values):
+    """Indexes of the values in a grid without the lines where there is no tile (one empty line is left
+    between separated values), and the value of each line of the grid (-1 for the empty ones)"""
+    unique = np.unique(values)
+    lines = np.concatenate([[0], np.cumsum(1 + (np.diff(unique) > 1))])
+    line_values = np.full(lines[-1] + 1, -1, dtype=np.int64)
+    line_values[lines] = unique
+    return lines[np.searchsorted(unique, values)], line_values
+
+
+def tiles_grid(tiles):
+    """Boolean grid of tiles (rows: y, columns: x), without the empty lines, with the x of its columns
+    and the y of its rows: neighbour tiles are neighbours in the grid"""
+    x, y = tiles_xy(tiles)
+    columns, column_x = _grid_indexes(x)
+    rows, row_y = _grid_indexes(y)
+    grid = np.zeros((len(row_y), len(column_x)), dtype=bool)
+    grid[rows, columns] = True
+    return grid, column_x, row_y
+
+
+def label_zones(grid):
+    """Zones of the grid (4-connected), as the zone number of each cell (-1 out of the zones)
+    and the size of each zone
+
+    Cells are grouped in horizontal runs, the runs connected to the runs below them get
+    the smallest zone number of them until it doesn't change."""
+    starts = grid & ~np.pad(grid, ((0, 0), (1, 0)))[:, :-1]
+    runs = np.cumsum(starts.ravel()).reshape(grid.shape) - 1
+    below = grid[:-1] & grid[1:]
+    upper, lower = runs[:-1][below], runs[1:][below]
+    zones = np.arange(starts.sum())
     while True:
-        if len(tiles) == 0:
+        linked = np.minimum(zones[upper], zones[lower])
+        new_zones = zones.copy()
+        np.minimum.at(new_zones, upper, linked)
+        np.minimum.at(new_zones, lower, linked)
+        new_zones = new_zones[new_zones]
+        if np.array_equal(new_zones, zones):
             break
+        zones = new_zones
+    zone_numbers, zones = np.unique(zones, return_inverse=True)
+    labels = np.where(grid, zones[runs], -1)
+    return labels, np.bincount(zones[runs[grid]], minlength=len(zone_numbers))
+
+
+def grid_outline(grid):
+    """Rings of the outline of the cells of a grid, as lists of (column, row) corners
+
+    Outer rings are clockwise (rows downwards), the rings of the holes counterclockwise.
+    Where two cells touch by a corner only, the rings go from one cell to the other: rings never touch
+    themselves, a hole can only touch the outer ring or another hole at a corner (a valid polygon)."""
+    padded = np.pad(grid, 1)
+    # Sides of the cells without neighbour, walked with the cell on the right
+    starts = []
+    directions = []
+    for outside, offset, direction in ((padded[:-2, 1:-1], (0, 0), (1, 0)), (padded[1:-1, 2:], (1, 0), (0, 1)),
+                                       (padded[2:, 1:-1], (1, 1), (-1, 0)), (padded[1:-1, :-2], (0, 1), (0, -1))):
+        rows, columns = np.nonzero(grid & ~outside)
+        starts.extend(zip((columns + offset[0]).tolist(), (rows + offset[1]).tolist()))
+        directions.extend([direction] * len(rows))
+    sides_from = {}
+    for side, start in enumerate(starts):
+        sides_from.setdefault(start, []).append(side)
+
+    used = bytearray(len(starts))
+    rings = []
+    for first in range(len(starts)):
+        ring = []
+        side = first
+        while not used[side]:
+            used[side] = 1
+            (x, y), (dx, dy) = starts[side], directions[side]
+            if not ring or (dx, dy) != directions[ring_side]:
+                ring.append((x, y))
+            ring_side = side
+            next_sides = sides_from[(x + dx, y + dy)]
+            # Cells touching by a corner: turn left, to the other cell
+            side = next_sides[0] if len(next_sides) == 1 else \
+                next(s for s in next_sides if directions[s] == (dy, -dx))
+        if ring:
+            if directions[ring_side] == directions[first]:
+                ring.pop(0)
+            rings.append(ring)
+    return rings
 
-        for c in tiles:
-            cluster = set([c])
-            boundary = set([c])
-            break
 
-        tiles -= cluster
-
-        while True:
-            new_c = set()
-            for tile in boundary:
-                x, y = tile
-                for dx, dy in adjoining:
-                    if (x + dx, y + dy) in tiles:
-                        new_c.add((x + dx, y + dy))
-            if new_c:
-                cluster |= new_c
-                boundary = new_c
-                tiles -= new_c
-            else:
-                break
-        clusters.append(cluster)
-
-    clusters.sort(key=len, reverse=True)
-    return clusters
+def compute_cluster(tiles):
+    if not tiles:
+        return 0
+    grid, column_x, row_y = tiles_grid(tiles)
+    # Tiles with their 4 neighbours
+    padded = np.pad(grid, 1)
+    cluster = grid & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    if not cluster.any():
+        return 0
 
+    labels, sizes = label_zones(cluster)
+    zone = labels == np.argmax(sizes)
+    rows = np.flatnonzero(zone.any(axis=1))
+    columns = np.flatnonzero(zone.any(axis=0))
+    zone = zone[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    # A zone doesn't cross empty lines, its tiles are the next ones of its first row and column
+    x0, y0 = column_x[columns[0]], row_y[rows[0]]
 
-adjoining = [(1, 0), (-1, 0), (0, 1), (0, -1) ]
+    outer = []
+    holes = []
+    for ring in grid_outline(zone):
+        corners = [coord_from_tile(x0 + x, y0 + y)[::-1] for x, y in ring]
+        clockwise = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1])) > 0
+        (outer if clockwise else holes).append(corners)
 
+    # The zone is connected: one outer ring
+    geom_z = Polygon(outer[0], holes)
 
-def compute_cluster(tiles):
-    if isinstance(list(tiles)[0], str):
-        tiles = set([tuple([int(i) for i in t.split('_')]) for t in tiles])
-    cluster_tiles = set()
-    for (x,y) in tiles:
-        for dx, dy in adjoining:
-            if (x + dx, y + dy) not in tiles:
-                break
-        else:
-            cluster_tiles.add((x, y))
-
-    if len(cluster_tiles)==0:
-        return 0
-    zones = compute_zones(cluster_tiles)
+    return getKmlFromGeom(geom_z)
 
-    geom_z = unary_union([Tile(*t).polygon for t in zones[0]])
 
-    return getKmlFromGeom(geom_z)
+def max_squares(tiles):
+    """Size of the largest squares of tiles, and the origin (x, y) (top left tile) of each of them
+
+    Dynamic programming on the grid of the tiles: the largest square ending at a tile is one more
+    than the smallest of the ones ending at its top, left and top left neighbours."""
+    if not tiles:
+        return 0, []
+    grid, column_x, row_y = tiles_grid(tiles)
+
+    width = grid.shape[1]
+    index = np.arange(width)
+    # Squares ending at each tile of the previous row, after a 0 for the left of the first column
+    previous = np.zeros(width + 1, dtype=np.int64)
+    size = 0
+    ends = []
+    for row in range(grid.shape[0]):
+        # Bounded by the top and top left neighbours, then by the left ones:
+        # square[i] = min(up[i], square[i-1] + 1) = min over j <= i of up[j] + i - j
+        up = np.where(grid[row], np.minimum(previous[1:], previous[:-1]) + 1, 0)
+        square = np.minimum.accumulate(up - index) + index
+        row_size = square.max()
+        if row_size > size:
+            size = int(row_size)
+            ends = []
+        if row_size == size:
+            ends.extend((row, column) for column in np.flatnonzero(square == size))
+        previous[1:] = square
+
+    return size, [(int(column_x[column - size + 1]), int(row_y[row - size + 1])) for row, column in ends]
 
 
 def compute_max_square(tiles):
-
-    def is_square(x, y, m):
-        for dx in range(m):
-            for dy in range(m):
-                uid = "{}_{}".format(x+dx, y+dy)
-                if uid not in tiles : return False
-        return True
-
-    max_square = 0
-    x_max = 0
-    y_max = 0
-    for tile in tiles:
-        x = int(tile.split('_')[0])
-        y = int(tile.split('_')[1])
-        while is_square(x, y, max_square+1):
-            max_square += 1
-            x_max = x
-            y_max = y
-    tiles = set()
-    for x in range(x_max, x_max+max_square):
-        for y in range(y_max, y_max+max_square):
-            tiles.add(Tile("{}_{}".format(x,y)))
-    geom_z = unary_union([t.polygon for t in tiles])
+    size, squares = max_squares(tiles)
+    if size == 0:
+        return getKmlFromGeom(unary_union([]))
+    x, y = squares[0]
+    lat_n, lon_w = coord_from_tile(x, y)
+    lat_s, lon_e = coord_from_tile(x + size, y + size)
+    geom_z = Polygon([(lon_w, lat_n), (lon_w, lat_s), (lon_e, lat_s), (lon_e, lat_n)])
     return getKmlFromGeom(geom_z)
 
 
@@ -1,4 +1,8 @@
-from shapely.geometry import Point, LineString, LinearRing, Polygon
+import json
+import os
+import threading
+
+from shapely.geometry import LineString, LinearRing, Polygon
 from fastkml import kml, styles
 
 from utils import *
@@ -176,76 +180,179 @@ class Tile(ZoneWithEntries):
             return
         router.get_area_rect(*self.edges[0], *self.edges[2])
 
-        tile = self.linear_ring(offset=10)
+        # Entry points depend on the OSM data of the tile and on the transport mode
+        version = router.area_version(*self.edges[0], *self.edges[2])
+        cache_file = None
+        if version is not None:
+            cache_file = os.path.join(router.cache_dir, "entrypoints", router.mode, "{}.json".format(self.uid))
+            if self._load_entry_points(router, cache_file, version):
+                print("Tile {} has {} entry nodes (cache)".format(self.name or self.uid, len(self.entryNodeId)))
+                return
+
+        ring = self.linear_ring(offset=10).coords
+        lat_min, lat_max = min(c[0] for c in ring), max(c[0] for c in ring)
+        lon_min, lon_max = min(c[1] for c in ring), max(c[1] for c in ring)
+
+        entry_nodes = set()
 
         def add_entry_point(node):
-            coord = Coord(*router.node_lat_lon(node), node)
-            # if coord not in self.entryNodeId:
-            if node not in [e.nodeId for e in self.entryNodeId]:
-                self.entryNodeId.append(coord)
-
-        new_points = []
-        new_points_id = []
-
-        for node_a, nodes in list(router.routing.items()):
-            latlon = router.node_lat_lon(node_a)
-            if distance(latlon, (self.lat, self.lon)) > 5:
-                continue
-            point_a = Point(*latlon)
-            for node_b in list(nodes):
-                point_b = Point(*router.node_lat_lon(node_b))
-                line = LineString([point_a, point_b])
-                if line.intersects(tile):
-                    intersect_points = line.intersection(tile)
-                    if intersect_points.geom_type == "Point":
-                        intersect_points = [intersect_points]
-                    elif intersect_points.geom_type == "Line":
-                        intersect_points = [intersect_points.coords[0], intersect_points.coords[-1]]
-                    else:
-                        intersect_points = list(intersect_points)
-
-                    intersect_points = list(intersect_points)
-
-                    if point_a in intersect_points:
-                        add_entry_point(node_a)
-                        intersect_points.remove(point_a)
-                    if point_b in intersect_points:
-                        add_entry_point(node_b)
-                        intersect_points.remove(point_b)
-
-                    intersect_points.sort(key=lambda p: LineString([point_a, p]).length)
-
-                    nodes_id = []
-                    for point in intersect_points:
-                        if point not in new_points:
-                            node_id = int((str(self.uid) + str(len(new_points))).replace("_", ""))
-                            router.rnodes[node_id] = (point.x, point.y)
-                            new_points.append(point)
-                            new_points_id.append(node_id)
-                            add_entry_point(node_id)
-                        else:
-                            node_id = new_points_id[new_points.index(point)]
-                        nodes_id.append(node_id)
-
-                    for node_id in nodes_id:
-                        if node_id not in router.routing:
-                            router.routing[node_id] = {}
-
-                    weight = router.routing[node_a][node_b]
-
-                    if node_a not in router.not_update_routing:
-                        router.not_update_routing[node_a] = []
-                    router.not_update_routing[node_a].append(node_b)
-                    n0 = node_a
-                    for n in nodes_id:
-                        router.routing[n0][n] = weight
-                        router.routing[n][node_b] = weight
-                        router.routing[n0].pop(node_b)
-                        n0 = n
+            if node not in entry_nodes:
+                entry_nodes.add(node)
+                self.entryNodeId.append(Coord(*router.node_lat_lon(node), node))
+
+        # Edges starting less than 5km from the tile
+        edges_a, edges_b = [], []
+        for node_a in router.node_index.within(self.lat, self.lon, 5):
+            if node_a in router.routing:
+                for node_b in router.routing[node_a]:
+                    edges_a.append(node_a)
+                    edges_b.append(node_b)
+        latlons_a = np.array([router.node_lat_lon(n) for n in edges_a], dtype=float).reshape(-1, 2)
+        latlons_b = np.array([router.node_lat_lon(n) for n in edges_b], dtype=float).reshape(-1, 2)
+
+        crossings = _ring_crossings(latlons_a, latlons_b, lat_min, lat_max, lon_min, lon_max)
+
+        new_points = {}
+        splits = []
+
+        for e in np.flatnonzero(crossings.any(axis=1)):
+            node_a, node_b = edges_a[e], edges_b[e]
+            point_a, point_b = tuple(latlons_a[e].tolist()), tuple(latlons_b[e].tolist())
+            intersect_points = _edge_crossing_points(point_a, point_b, crossings[e], lat_min, lat_max,
+                                                     lon_min, lon_max)
+
+            if point_a in intersect_points:
+                add_entry_point(node_a)
+                intersect_points.remove(point_a)
+            if point_b in intersect_points:
+                add_entry_point(node_b)
+                intersect_points.remove(point_b)
+
+            intersect_points.sort(key=lambda p: math.hypot(p[0] - point_a[0], p[1] - point_a[1]))
+
+            nodes_id = []
+            for point in intersect_points:
+                if point not in new_points:
+                    node_id = int((str(self.uid) + str(len(new_points))).replace("_", ""))
+                    router.add_node(node_id, *point)
+                    new_points[point] = node_id
+                    add_entry_point(node_id)
+                else:
+                    node_id = new_points[point]
+                nodes_id.append(node_id)
+
+            _split_edge(router, node_a, node_b, nodes_id)
+            splits.append([node_a, node_b, nodes_id])
+
+        if cache_file is not None:
+            data = {
+                "version": version,
+                "entry_nodes": [e.nodeId for e in self.entryNodeId],
+                "new_nodes": [[node_id, lat, lon] for (lat, lon), node_id in new_points.items()],
+                "splits": splits
+            }
+            # Written aside then renamed, other searches may read it at the same time
+            tmp_file = "{}.{}.{}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(tmp_file, "w") as hf:
+                    json.dump(data, hf)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                pass
 
         print("Tile {} has {} entry nodes".format(self.name or self.uid, len(self.entryNodeId)))
         return
 
+    def _load_entry_points(self, router, cache_file, version):
+        """Apply the entry points and edge splits saved for the same OSM data, return False if they can't be"""
+        try:
+            with open(cache_file) as hf:
+                data = json.load(hf)
+        except (OSError, ValueError):
+            # Missing or not valid JSON: computed again
+            return False
+        if not isinstance(data, dict) or data.get("version") != version:
+            return False
+
+        # Check everything before changing the graph: the edges to split must still be there
+        # (or already split, by a previous search on the same datastore)
+        new_nodes = {node_id: (lat, lon) for node_id, lat, lon in data["new_nodes"]}
+        for node_id, latlon in new_nodes.items():
+            if node_id in router.rnodes and tuple(router.node_lat_lon(node_id)) != latlon:
+                return False
+        to_split = []
+        for node_a, node_b, nodes_id in data["splits"]:
+            edges = router.routing.get(node_a, {})
+            if node_b in edges:
+                to_split.append((node_a, node_b, nodes_id))
+            elif not nodes_id or nodes_id[0] not in edges:
+                return False
+        if any(node_id not in router.rnodes and node_id not in new_nodes for node_id in data["entry_nodes"]):
+            return False
+
+        for node_id, latlon in new_nodes.items():
+            if node_id not in router.rnodes:
+                router.add_node(node_id, *latlon)
+        for node_a, node_b, nodes_id in to_split:
+            _split_edge(router, node_a, node_b, nodes_id)
+        self.entryNodeId = [Coord(*router.node_lat_lon(node_id), node_id) for node_id in data["entry_nodes"]]
+        return True
+
+
+def _split_edge(router, node_a, node_b, nodes_id):
+    """Replace the edge node_a -> node_b by a path through nodes_id, splitting its cost along them"""
+    # Split the edge cost along the new nodes
+    cost = router.routing[node_a][node_b]
+    length = distance(router.node_lat_lon(node_a), router.node_lat_lon(node_b))
+    cost_per_km = cost / length if length else 1
+
+    n0 = node_a
+    for n in nodes_id:
+        router.set_edge(n0, n, cost_per_km * distance(router.node_lat_lon(n0), router.node_lat_lon(n)))
+        router.set_edge(n, node_b, cost_per_km * distance(router.node_lat_lon(n), router.node_lat_lon(node_b)))
+        router.remove_edge(n0, node_b)
+        n0 = n
+
+
+def _ring_crossings(a, b, lat_min, lat_max, lon_min, lon_max):
+    """For arrays of segments a-b (lat, lon), which ones touch each side of the rectangle
+
+    Return a boolean array (segments, 4): sides lat_min, lat_max, lon_min, lon_max"""
+    crossings = np.zeros((len(a), 4), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for side, (axis, value) in enumerate(((0, lat_min), (0, lat_max), (1, lon_min), (1, lon_max))):
+            other = 1 - axis
+            low, high = (lon_min, lon_max) if axis == 0 else (lat_min, lat_max)
+            t = (value - a[:, axis]) / (b[:, axis] - a[:, axis])
+            crossing = a[:, other] + t * (b[:, other] - a[:, other])
+            crossings[:, side] = (t >= 0) & (t <= 1) & (crossing >= low) & (crossing <= high)
+    return crossings
+
+
+def _edge_crossing_points(point_a, point_b, sides, lat_min, lat_max, lon_min, lon_max):
+    """Points (lat, lon) where the segment point_a-point_b touches the given rectangle sides"""
+    points = []
+    for side, (axis, value) in enumerate(((0, lat_min), (0, lat_max), (1, lon_min), (1, lon_max))):
+        if not sides[side]:
+            continue
+        # An edge end on the side is kept as it is, so that it is recognized as the node
+        if point_a[axis] == value:
+            point = point_a
+        elif point_b[axis] == value:
+            point = point_b
+        else:
+            # Computed from the lowest end, to get the same point for both directions of a way
+            low, high = sorted((point_a, point_b))
+            t = (value - low[axis]) / (high[axis] - low[axis])
+            point = [0, 0]
+            point[axis] = value
+            point[1 - axis] = low[1 - axis] + t * (high[1 - axis] - low[1 - axis])
+            point = tuple(point)
+        if point not in points:
+            points.append(point)
+    return points
+
 
 def tiles_to_kml(tiles, filename, name):
     # Create the root KML object
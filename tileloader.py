@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pyroutelib3 import Datastore, TYPES, ZOOM_LEVEL, _which_tile
+from tile import Tile
+
+# Parallel downloads (the OSM API doesn't like much more)
+DOWNLOAD_WORKERS = 4
+# Zoom 15 tiles prefetched around the route area
+PREFETCH_MARGIN = 1
+MAX_PREFETCH_TILES = 400
+# Processes parsing the tiles, the search keeps a CPU (no processes with a single CPU)
+PARSE_PROCESSES = (os.cpu_count() or 1) - 1
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+# Datastores of a worker process, by mode
+_worker_datastores = {}
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn: the server process has threads, it is not safe to fork it
+            _process_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def compile_tile_file(mode, filename):
+    """Write the compiled file of an OSM file, in a worker process"""
+    if mode not in _worker_datastores:
+        _worker_datastores[mode] = Datastore(mode)
+    _worker_datastores[mode].compiled_osm(filename)
+
+
+def route_tiles(start, end, tiles_ids, waypoints=()):
+    """OSM tiles (x, y, z) around a route: start, end and waypoints area, and the tiles to visit"""
+    points = [start, end] + list(waypoints)
+    areas = [(min(p[0] for p in points), min(p[1] for p in points),
+              max(p[0] for p in points), max(p[1] for p in points))]
+    for tile_id in tiles_ids:
+        tile = Tile(tile_id)
+        areas.append((tile.latS, tile.lonW, tile.latN, tile.lonE))
+
+    tiles = []
+    for lat_s, lon_w, lat_n, lon_e in areas:
+        x1, y1, z = _which_tile(lat_n, lon_w, ZOOM_LEVEL)
+        x2, y2, z = _which_tile(lat_s, lon_e, ZOOM_LEVEL)
+        for x in range(x1 - PREFETCH_MARGIN, x2 + PREFETCH_MARGIN + 1):
+            for y in range(y1 - PREFETCH_MARGIN, y2 + PREFETCH_MARGIN + 1):
+                if (x, y, z) not in tiles:
+                    tiles.append((x, y, z))
+    return tiles[:MAX_PREFETCH_TILES]
+
+
+class TileLoader(object):
+    """Load the tiles of a Datastore in background
+
+    Tiles are downloaded by a pool of threads, parsed by a pool of processes (which write their compiled
+    files), then merged in the graph. Datastore.get_tile waits for a tile being loaded here instead of
+    loading it again, and loads the tiles not started yet itself."""
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._downloads = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+
+    def wait(self, tile_id):
+        """Wait for a tile being loaded in background, return False if it isn't one
+
+        A tile still queued behind the other prefetched tiles is taken back from the queue (False is
+        returned): the search loads it itself instead of waiting for them."""
+        with self._lock:
+            future = self._futures.get(tile_id)
+            if future is None:
+                return False
+            if future.cancel():
+                del self._futures[tile_id]
+                return False
+        future.result()
+        return True
+
+    def prefetch(self, tiles):
+        """Start loading tiles (x, y, z) in background"""
+        with self._lock:
+            for x, y, z in tiles:
+                tile_id = "{0},{1}".format(x, y)
+                if self.datastore.should_load(tile_id) and tile_id not in self._futures:
+                    self._futures[tile_id] = self._downloads.submit(self._load, x, y, z)
+
+    def prefetch_route(self, start, end, tiles_ids, waypoints=()):
+        """Start loading the tiles around the route: start, end and waypoints area, and the tiles to visit"""
+        self.prefetch(route_tiles(start, end, tiles_ids, waypoints))
+
+    def _load(self, x, y, z):
+        tile_id = "{0},{1}".format(x, y)
+        try:
+            filename = self.datastore.download_tile(x, y, z)
+            # Modes with custom weights can't be sent to a process, they are parsed by load_tile
+            if PARSE_PROCESSES > 0 and self.datastore.mode in TYPES and \
+                    self.datastore.type == TYPES[self.datastore.mode]:
+                try:
+                    _get_process_pool().submit(compile_tile_file, self.datastore.mode, filename).result()
+                except Exception:
+                    # Parsed again by load_tile, which handles the errors
+                    pass
+            self.datastore.load_tile(x, y, z)
+        except Exception:
+            # Tried again after TILE_RETRY_DELAY, by the search or by the next prefetch
+            traceback.print_exc()
+            self.datastore.tile_failed(tile_id)
+            with self._lock:
+                self._futures.pop(tile_id, None)
@@ -1,15 +1,23 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import heapq
+import itertools
 import threading
+import time
+from functools import partial
 from pathlib import Path
 
 import gpxpy
 import gpxpy.gpx
 from shapely.geometry import Point, Polygon
 
+from heuristic import MinDistHeuristic
+from overlay import DatastoreOverlay
 from pyroutelib3 import Datastore
+from routecache import route_key
 from tile import Tile, CoordDict
+from tileloader import TileLoader
 from utils import *
 
 def latlons_to_gpx(latlons, filename, name):
@@ -36,17 +44,24 @@ class Route(object):
     def __init__(self, route, router):
         self.route = route
         self.routeLatLons = list(map(router.node_lat_lon, route))
-        self.compute_length(self.routeLatLons)
         self.length = self.compute_length(self.routeLatLons)
 
+    def to_dict(self):
+        return {"route": list(self.route), "latlons": [list(latlon) for latlon in self.routeLatLons],
+                "length": self.length}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Route stored with to_dict, without the router it was found on"""
+        route = cls.__new__(cls)
+        route.route = data["route"]
+        route.routeLatLons = [tuple(latlon) for latlon in data["latlons"]]
+        route.length = data["length"]
+        return route
+
     @staticmethod
     def compute_length(route_latlons):
-        length = 0
-        previous = route_latlons[0]
-        for latlon in route_latlons[1:]:
-            length += distance(previous, latlon)
-            previous = latlon
-        return length
+        return path_length(route_latlons)
 
     def to_gpx(self, filename, name):
         return latlons_to_gpx(self.routeLatLons, filename, name)
@@ -67,19 +82,140 @@ def debug_export_tiles(tiles):
                 hf.write("[{},{}],\n".format(*e.latlon))
         hf.write("];\n")
 
+class SearchNode(object):
+    """Node of a route search tree
+
+    A searched path is only stored as its last node and a pointer to the path it extends,
+    so extending a path is O(1) and the node list is rebuilt only when needed.
+    """
+    __slots__ = ('node', 'parent', 'count')
+
+    def __init__(self, node, parent=None):
+        self.node = node
+        self.parent = parent
+        self.count = parent.count + 1 if parent else 1
+
+    def __repr__(self):
+        return "SearchNode({}, count={})".format(self.node, self.count)
+
+    def last_nodes(self, n):
+        """Return the (up to) n last node ids of the path, in path order"""
+        nodes = []
+        search_node = self
+        while search_node and len(nodes) < n:
+            nodes.append(search_node.node)
+            search_node = search_node.parent
+        nodes.reverse()
+        return nodes
+
+    def path(self):
+        """Return the node ids of the whole path"""
+        return self.last_nodes(self.count)
+
+
+class SearchQueue(object):
+    """Open set of the route searches
+
+    Items are kept in a binary heap ordered by priority (ties are popped in insertion order),
+    and indexed by search state so the queued items reaching a state are found in O(1).
+    Removed items are only marked and skipped when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._index = {}
+        self._counter = itertools.count()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key, priority, item):
+        entry = [priority, next(self._counter), key, item]
+        heapq.heappush(self._heap, entry)
+        self._index.setdefault(key, []).append(entry)
+        self._size += 1
+
+    def _first(self, key):
+        entries = self._index.get(key)
+        if not entries:
+            return None
+        return min(entries) if len(entries) > 1 else entries[0]
+
+    def get(self, key):
+        """Return the first queued item reaching the state key, or None"""
+        entry = self._first(key)
+        return entry[3] if entry else None
+
+    def remove(self, key):
+        """Remove the first queued item reaching the state key"""
+        entry = self._first(key)
+        self._unindex(entry)
+        entry[3] = None
+        self._size -= 1
+
+    def _unindex(self, entry):
+        entries = self._index[entry[2]]
+        if len(entries) == 1:
+            del self._index[entry[2]]
+        else:
+            entries.remove(entry)
+
+    def pop(self):
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[3] is None:
+                continue
+            self._unindex(entry)
+            self._size -= 1
+            return entry[3]
+        raise IndexError("pop from an empty search queue")
+
+    def items(self):
+        """Queued items, in pop order"""
+        return [entry[3] for entry in sorted(self._heap) if entry[3] is not None]
+
+
 ERR_NO = 0
 ERR_NO_TILE_ENTRY_POINT = 1
 ERR_ABORT_REQUEST = 2
 ERR_ROUTE_ERROR = 1000
 
+# Listeners of a search are notified of its progress at most at this interval (in s)
+UPDATE_INTERVAL = 0.2
+
+
+class RouteUpdates(object):
+    """Notify the listeners of a route search (progress, minimal route, completion) of its changes"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Wait for a change after version, return the current version"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
 class MyRouter(object):
-    def __init__(self, router, start, end, tiles_ids, ways_points, config):
+    def __init__(self, router, start, end, tiles_ids, ways_points, config, cancel=None):
         self.router = router
         self._min_route = None
+        # (search node, its Route) of the last min_route read during the search
+        self._min_route_cache = None
         self.min_length = None
         self.error_code = ERR_NO
         self.error_args = ""
-        self._exit = False
+        # Set to abort the search (threading.Event, or a flag shared with another process)
+        self.cancel = cancel if cancel is not None else threading.Event()
+        self.updates = RouteUpdates()
+        self._next_update = 0
         self._complete = False
         self.start = start
         self.end = end
@@ -88,15 +224,22 @@ class MyRouter(object):
         self.progress = 100.0
         self.config = config
         self.stored_tiles = {}
+        self.expansions = 0
 
     def abort(self):
-        self._exit = True
+        self.cancel.set()
 
     @property
     def is_complete(self):
         return self._complete
 
     def run(self):
+        try:
+            return self._run()
+        finally:
+            self.updates.notify()
+
+    def _run(self):
         self.min_length = None
         self._min_route = None
         self.error_code = ERR_NO
@@ -104,7 +247,7 @@ class MyRouter(object):
 
         selected_tiles = []
         for t in self.tiles_ids:
-            if self._exit:
+            if self.cancel.is_set():
                 self.error_code = ERR_ABORT_REQUEST
                 return False
 
@@ -149,20 +292,26 @@ class MyRouter(object):
 
     @property
     def min_route(self):
-        if self._min_route is None:
-            return None
-        if isinstance(self._min_route, str):
-            self._min_route = Route([int(i) for i in self._min_route.split(",")], router=self.router)
-        return self._min_route
-
-    def explore_routes_tile_exit(self, start, tile, mandatoryNodes):
+        # Read once: the search thread can replace it meanwhile
+        min_route = self._min_route
+        if isinstance(min_route, SearchNode):
+            # The Route of the last search node is kept, not stored in _min_route which belongs to the search
+            cache = self._min_route_cache
+            if cache is None or cache[0] is not min_route:
+                cache = self._min_route_cache = (min_route, Route(min_route.path(), router=self.router))
+            return cache[1]
+        return min_route
+
+    def explore_routes_tile_exit(self, start, tile, mandatoryNodes, restrictions=()):
         """Do the routing"""
         _closed = set()
-        _queue = []
+        _queue = SearchQueue()
         _closeNode = True
 
-        if start in tile.routesEntryNodes:
-            return tile.routesEntryNodes[start]
+        # Routes across the tile depend on the turn restrictions and the mandatory turns being followed
+        cache_key = (start, tuple(restrictions), tuple(mandatoryNodes or ()))
+        if cache_key in tile.routesEntryNodes:
+            return tile.routesEntryNodes[cache_key]
 
         tile_bounds = Polygon(tile.linear_ring(offset=9.9))
 
@@ -173,7 +322,7 @@ class MyRouter(object):
             with open('debug/routes.js', 'w') as hf:
                 hf.write("var routes = [\n")
                 if new_item:
-                    route = [int(i) for i in new_item["nodes"].split(",")]
+                    route = new_item["node"].path()
                     hf.write(" { \n")
                     hf.write("  'name':'{0:.3f}',\n".format(new_item['cost']))
                     hf.write("  'length':{},\n".format(new_item['cost']))
@@ -182,8 +331,8 @@ class MyRouter(object):
                         hf.write("[{},{}],\n".format(lat, lon))
                     hf.write("  ],\n")
                     hf.write("  },\n")
-                for q in _queue+find_routes:
-                    route = [int(i) for i in q["nodes"].split(",")]
+                for q in _queue.items()+find_routes:
+                    route = q["node"].path()
                     hf.write(" { \n")
                     hf.write("  'name':'{0:.3f}',\n".format(q['cost']))
                     hf.write("  'length':{},\n".format(q['cost']))
@@ -195,20 +344,10 @@ class MyRouter(object):
                 hf.write("];\n")
 
         def _queue_insert(queue_item):
-            nonlocal _queue
-            # Try to insert, keeping the queue ordered by decreasing heuristic cost
-            position = 0
-            for test in _queue:
-                if test["cost"] > queue_item["cost"]:
-                    _queue.insert(position, queue_item)
-                    break
-                position += 1
-
-            else:
-                _queue.append(queue_item)
+            _queue.push(queue_item["end"], queue_item["cost"], queue_item)
 
         # Define function that addes to the queue
-        def _add_to_queue(item_start, item_end, queue_so_far, item_weight=1):
+        def _add_to_queue(item_start, item_end, queue_so_far, edge_cost):
             """Add another potential route to the queue"""
             nonlocal _closed, _queue, _closeNode
 
@@ -219,68 +358,57 @@ class MyRouter(object):
             # Get data around end node
             self.router.get_area(self.router.rnodes[item_end][0], self.router.rnodes[item_end][1])
 
-            # Ignore if route is not traversible
-            if item_weight == 0:
-                return
-
             # Do not turn around at a node (don't do this: a-b-a)
             # if len(queueSoFar["nodes"].split(",")) >= 2 and queueSoFar["nodes"].split(",")[-2] == str(end):
             #    return
 
-            edge_cost = distance(self.router.rnodes[item_start], self.router.rnodes[item_end]) / item_weight
-
             total_cost = queue_so_far["cost"] + edge_cost
 
-            all_nodes = queue_so_far["nodes"] + "," + str(item_end)
+            search_node = SearchNode(item_end, queue_so_far["node"])
 
             # Check if path queueSoFar+end is not forbidden
-            for i in self.router.forbiddenMoves:
-                if i in all_nodes:
-                    _closeNode = False
-                    return
+            restrictions = self.router.next_restriction_state(queue_so_far.get("restrictions", ()),
+                                                              item_start, item_end)
+            if restrictions is None:
+                _closeNode = False
+                return
 
             # Check if we have a way to 'end' node
-            end_queue_item = None
-            for i in _queue:
-                if i["end"] == item_end:
-                    end_queue_item = i
-                    break
+            end_queue_item = _queue.get(item_end)
 
-            if end_queue_item :
+            if end_queue_item:
                 # If we do, and known total_cost to end is lower we can ignore the queueSoFar path
                 if end_queue_item["cost"] < total_cost:
                     return
                 # If the queued way to end has higher total cost, remove it
                 # (and add the queueSoFar scenario, as it's cheaper)
-                elif end_queue_item:
-                    _queue.remove(end_queue_item)
+                _queue.remove(item_end)
 
             # Check against mandatory turns
             force_next_nodes = None
             if queue_so_far.get("mandatoryNodes", None):
                 force_next_nodes = queue_so_far["mandatoryNodes"]
 
-            else:
-                for activationNodes, nextNodes in self.router.mandatoryMoves.items():
-                    if all_nodes.endswith(activationNodes):
-                        _closeNode = False
-                        force_next_nodes = nextNodes.copy()
-                        break
+            elif (item_start, item_end) in self.router.mandatoryMoves:
+                _closeNode = False
+                force_next_nodes = self.router.mandatoryMoves[(item_start, item_end)].copy()
 
             # Create a hash for all the route's attributes
             queue_item = {
                 "cost": total_cost,
-                "nodes": all_nodes,
+                "node": search_node,
                 "end": item_end,
-                "mandatoryNodes": force_next_nodes
+                "mandatoryNodes": force_next_nodes,
+                "restrictions": restrictions
             }
             _queue_insert(queue_item)
 
         queue_item = {
             "cost": 0,
-            "nodes": str(start),
+            "node": SearchNode(start),
             "end": start,
-            "mandatoryNodes": mandatoryNodes
+            "mandatoryNodes": mandatoryNodes,
+            "restrictions": restrictions
         }
         _queue_insert(queue_item)
 
@@ -289,7 +417,7 @@ class MyRouter(object):
             # _export_queue()
 
             # Pop first item from queue for routing. If queue it's empty - it means no route exists
-            next_item = _queue.pop(0)
+            next_item = _queue.pop()
 
             considered_node = next_item["end"]
 
@@ -313,34 +441,34 @@ class MyRouter(object):
 
             # If no, add all possible nodes from x to queue
             elif considered_node in self.router.routing:
-                for next_node, weight in list(self.router.routing[considered_node].items()):
+                for next_node, cost in list(self.router.routing[considered_node].items()):
                     if next_node not in _closed:
-                        _add_to_queue(considered_node, next_node, next_item, weight)
+                        _add_to_queue(considered_node, next_node, next_item, cost)
 
             if _closeNode:
                 _closed.add(considered_node)
 
         #_export_queue()
-        tile.routesEntryNodes[start] = find_routes
+        tile.routesEntryNodes[cache_key] = find_routes
         return find_routes
 
     def do_route_with_crossing_zone(self, start, end, zones, config):
         """Do the routing"""
-        _closed = {(start, frozenset(zones))}
-        _queue = []
+        # Zones are numbered by the heuristic, the not visited zones of a search state are a bitmask
+        heuristic = MinDistHeuristic(self.router, zones, end)
+        all_zones = (1 << len(heuristic.zones)) - 1
+        _closed = {(start, all_zones)}
+        _queue = SearchQueue()
         _closeNode = True
-        _end = end
-        min_dists = {}
-        min_dists_fast = {}
 
         def _export_queue(new_item=None):
             nonlocal _closed, _queue, _closeNode
             with open('debug/routes.js', 'w') as hf:
                 hf.write("var routes = [\n")
                 if new_item:
-                    route = [int(i) for i in new_item["nodes"].split(",")]
+                    route = new_item["node"].path()
                     hf.write(" { \n")
-                    hf.write("  'name':'{0}-{1:.3f}',\n".format(len(new_item['not_visited_zones']),
+                    hf.write("  'name':'{0}-{1:.3f}',\n".format(bin(new_item['not_visited_zones']).count("1"),
                                                                 new_item['heuristic_cost']))
                     hf.write("  'length':{},\n".format(new_item['cost']))
                     hf.write("  'route':[\n")
@@ -348,10 +476,10 @@ class MyRouter(object):
                         hf.write("[{},{}],\n".format(lat, lon))
                     hf.write("  ],\n")
                     hf.write("  },\n")
-                for q in _queue:
-                    route = [int(i) for i in q["nodes"].split(",")]
+                for q in _queue.items():
+                    route = q["node"].path()
                     hf.write(" { \n")
-                    hf.write("  'name':'{0}-{1:.3f}',\n".format(len(q['not_visited_zones']), q['heuristic_cost']))
+                    hf.write("  'name':'{0}-{1:.3f}',\n".format(bin(q['not_visited_zones']).count("1"), q['heuristic_cost']))
                     hf.write("  'length':{},\n".format(q['cost']))
                     hf.write("  'route':[\n")
                     for lat, lon in list(map(self.router.node_lat_lon, route)):
@@ -361,22 +489,13 @@ class MyRouter(object):
                 hf.write("];\n")
 
         def _queue_insert(queue_item):
-            nonlocal _queue
-            # Try to insert, keeping the queue ordered by decreasing heuristic cost
-            position = 0
-            for test in _queue:
-                if test["heuristic_cost"] > queue_item["heuristic_cost"]:
-                    _queue.insert(position, queue_item)
-                    break
-                position += 1
-
-            else:
-                _queue.append(queue_item)
+            _queue.push((queue_item["end"], queue_item["not_visited_zones"]), queue_item["heuristic_cost"],
+                        queue_item)
 
         # Define function that addes to the queue
-        def _add_to_queue(item_start, item_not_visited_zones, item_end, queue_so_far, item_weight=1):
+        def _add_to_queue(item_start, item_not_visited_zones, item_end, queue_so_far, edge_cost):
             """Add another potential route to the queue"""
-            nonlocal _closed, _queue, _closeNode, min_dists, min_dists_fast
+            nonlocal _closed, _queue, _closeNode
 
             # Assume start and end nodes have positions
             if item_end not in self.router.rnodes or item_start not in self.router.rnodes:
@@ -385,106 +504,62 @@ class MyRouter(object):
             # Get data around end node
             self.router.get_area(self.router.rnodes[item_end][0], self.router.rnodes[item_end][1])
 
-            # Ignore if route is not traversible
-            if item_weight == 0:
-                return
-
             # Do not turn around at a node (don't do this: a-b-a)
             # if len(queueSoFar["nodes"].split(",")) >= 2 and queueSoFar["nodes"].split(",")[-2] == str(end):
             #    return
 
-            edge_cost = distance(self.router.rnodes[item_start], self.router.rnodes[item_end]) / item_weight
-
             # if turn around add additional cost
             if config.get('turnaround_cost', 0)>0:
-                queue_so_far_nodes = queue_so_far["nodes"].split(',')
-                if len(queue_so_far_nodes)>2:
-                    if str(item_end) == queue_so_far_nodes[-2]:
+                queue_so_far_node = queue_so_far["node"]
+                if queue_so_far_node.count>2:
+                    if item_end == queue_so_far_node.parent.node:
                         #_export_queue(queue_so_far)
                         #print("Turnaround cost")
                         edge_cost += config['turnaround_cost']
 
             total_cost = queue_so_far["cost"] + edge_cost
 
-            def _min_dist(start_loc, tiles, end_loc, store=True, fast=False):
-                nonlocal min_dists, min_dists_fast
-                if self._exit:
-                    return 0
-                md = min_dists_fast if fast else min_dists
-                # compute flyby min distance by visiting all tiles
-                if len(tiles) == 0:
-                    return distance(start_loc, end_loc)
-
-                if (start_loc, frozenset(tiles), end_loc) in md:
-                    return md[(start_loc, frozenset(tiles), end_loc)]
-
-                min_dist = None
-                for t in tiles:
-                    remain_tiles = set(tiles) - {t}
-                    if fast and len(t.entryNodeId) > 4:
-                        ep = t.edges
-                    else:
-                        ep = [n.latlon for n in t.entryNodeId]
-                    for entry in ep:
-                        pa = distance(start_loc, entry)
-                        pb = _min_dist(entry, remain_tiles, end_loc, fast=fast)
-                        if min_dist is None or pa + pb < min_dist:
-                            min_dist = pa + pb
-                if store:
-                    md[(start_loc, frozenset(tiles), end_loc)] = min_dist
-                return min_dist
-
-            # t = time.time() if len(min_dists)==0 else None
-            hc = _min_dist(self.router.rnodes[item_end], item_not_visited_zones, self.router.rnodes[_end], False,
-                           len(item_not_visited_zones) > 5)
-            # if t:
-            # print("min dist time:{}".format(time.time()-t))
+            hc = heuristic.min_dist(item_end, item_not_visited_zones)
             heuristic_cost = total_cost + hc
 
-            all_nodes = queue_so_far["nodes"] + "," + str(item_end)
+            search_node = SearchNode(item_end, queue_so_far["node"])
 
             # Check if path queueSoFar+end is not forbidden
-            for i in self.router.forbiddenMoves:
-                if i in all_nodes:
-                    _closeNode = False
-                    return
+            restrictions = self.router.next_restriction_state(queue_so_far.get("restrictions", ()),
+                                                              item_start, item_end)
+            if restrictions is None:
+                _closeNode = False
+                return
 
             # Check if we have a way to 'end' node
-            end_queue_item = None
-            for i in _queue:
-                if (i["end"], i["not_visited_zones"]) == (item_end, item_not_visited_zones):
-                    end_queue_item = i
-                    break
+            end_queue_item = _queue.get((item_end, item_not_visited_zones))
 
-            if end_queue_item :
+            if end_queue_item:
                 # If we do, and known total_cost to end is lower we can ignore the queueSoFar path
                 if end_queue_item["cost"] < total_cost:
                     return
                 # If the queued way to end has higher total cost, remove it
                 # (and add the queueSoFar scenario, as it's cheaper)
-                elif end_queue_item:
-                    _queue.remove(end_queue_item)
+                _queue.remove((item_end, item_not_visited_zones))
 
             # Check against mandatory turns
             force_next_nodes = None
             if queue_so_far.get("mandatoryNodes", None):
                 force_next_nodes = queue_so_far["mandatoryNodes"]
 
-            else:
-                for activationNodes, nextNodes in self.router.mandatoryMoves.items():
-                    if all_nodes.endswith(activationNodes):
-                        _closeNode = False
-                        force_next_nodes = nextNodes.copy()
-                        break
+            elif (item_start, item_end) in self.router.mandatoryMoves:
+                _closeNode = False
+                force_next_nodes = self.router.mandatoryMoves[(item_start, item_end)].copy()
 
             # Create a hash for all the route's attributes
             queue_item = {
                 "cost": total_cost,
                 "heuristic_cost": heuristic_cost,
-                "nodes": all_nodes,
+                "node": search_node,
                 "end": item_end,
                 "not_visited_zones": item_not_visited_zones,
-                "mandatoryNodes": force_next_nodes
+                "mandatoryNodes": force_next_nodes,
+                "restrictions": restrictions
             }
 
             _queue_insert(queue_item)
@@ -498,21 +573,21 @@ class MyRouter(object):
             return "no_route", []
 
         else:
-            not_visited_zones = frozenset(zones)
+            not_visited_zones = all_zones
             for linkedNode in list(self.router.routing[start]):
-                weight = self.router.routing[start][linkedNode]
-                _add_to_queue(start, not_visited_zones, linkedNode, {"cost": 0, "nodes": str(start)}, weight)
+                cost = self.router.routing[start][linkedNode]
+                _add_to_queue(start, not_visited_zones, linkedNode, {"cost": 0, "node": SearchNode(start)}, cost)
 
-        # Limit for how long it will search
-        count = 0
-        while not self._exit:
-            count += 1
+        # Limit for how long it will search, the cancellation is checked every 256 expansions
+        self.expansions = 0
+        while self.expansions & 0xff or not self.cancel.is_set():
+            self.expansions += 1
             _closeNode = True
             #_export_queue()
 
             # Pop first item from queue for routing. If queue it's empty - it means no route exists
             if len(_queue) > 0:
-                next_item = _queue.pop(0)
+                next_item = _queue.pop()
             else:
                 return "no_route", []
 
@@ -521,35 +596,48 @@ class MyRouter(object):
 
             if not self.min_length or next_item['cost'] > self.min_length:
                 self.min_length = next_item['cost']
-                self._min_route = next_item['nodes']
+                self._min_route = next_item['node']
                 self.progress = 100.0 * next_item['cost'] / next_item['heuristic_cost']
                 print_progress_bar(next_item['cost'], next_item['heuristic_cost'])
+                if time.monotonic() >= self._next_update:
+                    self._next_update = time.monotonic() + UPDATE_INTERVAL
+                    self.updates.notify()
 
             is_enter_new_tile = False
-            for zone in not_visited_zones:
-                if considered_node in zone.entry_nodes_id:
+            entered_zones = heuristic.node_zones.get(considered_node, 0) & not_visited_zones
+            if entered_zones:
+                for zone_index in heuristic.zone_indexes(entered_zones):
                     # Enter in a new zone
-                    not_visited_zones = not_visited_zones - {zone}
+                    zone = heuristic.zones[zone_index]
+                    not_visited_zones &= ~(1 << zone_index)
                     if config.get('turnaround_cost', 0)>0 and len(zone.entry_nodes_id)>1:
                         is_enter_new_tile = True
-                        routes_across_tile = self.explore_routes_tile_exit(considered_node, zone, next_item['mandatoryNodes'])
+                        routes_across_tile = self.explore_routes_tile_exit(considered_node, zone,
+                                                                               next_item['mandatoryNodes'],
+                                                                               next_item['restrictions'])
                         for route in routes_across_tile:
-                            first_nodes = next_item['nodes'].split(',')[:-1]
+                            route_nodes = route['node'].path()
                             add_cost = 0
-                            if first_nodes[-1] in route['nodes'].split(','):
+                            if next_item['node'].parent and next_item['node'].parent.node in route_nodes:
                                 add_cost += config.get('turnaround_cost', 0)
 
+                            # Graft the route across the tile (which starts by considered_node) on the path
+                            search_node = next_item['node']
+                            for node in route_nodes[1:]:
+                                search_node = SearchNode(node, search_node)
+
 
                             queue_item = {
                                 "cost": next_item['cost'] + route['cost'] + add_cost,
                                 "heuristic_cost": next_item['heuristic_cost'] + route['cost'] + add_cost,
-                                "nodes": next_item['nodes'] + ',' + route['nodes'],
+                                "node": search_node,
                                 "end": route['end'],
                                 "not_visited_zones": not_visited_zones,
-                                "mandatoryNodes": route['mandatoryNodes']
+                                "mandatoryNodes": route['mandatoryNodes'],
+                                "restrictions": route['restrictions']
                             }
                             _queue_insert(queue_item)
-                            _closed.add((int(route['nodes'].split(',')[-2]), not_visited_zones))
+                            _closed.add((search_node.parent.node, not_visited_zones))
             if is_enter_new_tile:
                 _closed.add((considered_node, not_visited_zones))
                 #_export_queue()
@@ -561,10 +649,10 @@ class MyRouter(object):
 
             # Found the end node - success
             if considered_node == end:
-                if len(not_visited_zones) == 0:
+                if not_visited_zones == 0:
                     _export_queue(next_item)
                     print(next_item)
-                    return "success", [int(i) for i in next_item["nodes"].split(",")]
+                    return "success", next_item["node"].path()
 
             # Check if we preform a mandatory turn
             if next_item["mandatoryNodes"]:
@@ -577,9 +665,9 @@ class MyRouter(object):
 
             # If no, add all possible nodes from x to queue
             elif considered_node in self.router.routing:
-                for next_node, weight in list(self.router.routing[considered_node].items()):
+                for next_node, cost in list(self.router.routing[considered_node].items()):
                     if (next_node, not_visited_zones) not in _closed:
-                        _add_to_queue(considered_node, not_visited_zones, next_node, next_item, weight)
+                        _add_to_queue(considered_node, not_visited_zones, next_node, next_item, cost)
 
             if _closeNode:
                 _closed.add((considered_node, not_visited_zones))
@@ -594,10 +682,65 @@ class MyRouter(object):
             return False
 
 
+# Tiles cache of the server
+TILES_CACHE_DIR = str(Path.home().joinpath('.tilescache'))
+
+# Datastores shared by all the route servers, by (mode, compact_graph)
+_datastores = {}
+_datastores_lock = threading.Lock()
+
+
+def shared_datastore(mode, compact_graph=False):
+    """Datastore of a transport mode, shared by all the route servers of the process"""
+    with _datastores_lock:
+        if (mode, compact_graph) not in _datastores:
+            datastore = Datastore(mode, cache_dir=TILES_CACHE_DIR, compact_graph=compact_graph)
+            datastore.tile_loader = TileLoader(datastore)
+            _datastores[(mode, compact_graph)] = datastore
+        return _datastores[(mode, compact_graph)]
+
+
+def create_router(mode, start_loc, end_loc, tiles, waypoints, config, compact_graph=False, cancel=None):
+    """MyRouter of a route request, on the shared Datastore of its mode"""
+    datastore = shared_datastore(mode, compact_graph)
+    # Load the tiles around the route while the search starts
+    datastore.tile_loader.prefetch_route(start_loc, end_loc, tiles, waypoints)
+    # The shared graph is only read, the changes of this request go in its overlay
+    router = DatastoreOverlay(datastore)
+    coord_dict = CoordDict(router)
+    start_point = coord_dict.get(*start_loc)
+    end_point = coord_dict.get(*end_loc)
+    ways_points = [coord_dict.get(*wp) for wp in waypoints]
+    print("Ways_points")
+    print(ways_points)
+    return MyRouter(router, start_point, end_point, tiles, ways_points, config, cancel)
+
+
+class CachedRouter(object):
+    """MyRouter of a route found in a RouteCache"""
+
+    def __init__(self, route):
+        self.min_route = route
+        self.progress = 100.0
+        self.error_code = ERR_NO
+        self.error_args = ""
+        self.is_complete = True
+        self.updates = RouteUpdates()
+
+    def abort(self):
+        pass
+
+    def generate_gpx(self, file_name, gpx_name):
+        return self.min_route.to_gpx(file_name, gpx_name)
+
+
 class RouteServer(object):
-    def __init__(self):
-        self.stored_tiles = {}
-        self.router = None
+    def __init__(self, compact_graph=False, pool=None, cache=None):
+        self.compact_graph = compact_graph
+        # Optional RoutingPool, computing the routes in worker processes
+        self.pool = pool
+        # Optional RouteCache, shared by the route servers
+        self.cache = cache
         self.myRouter = None
         self.mode = None
         self.thread = None
@@ -606,39 +749,61 @@ class RouteServer(object):
         if config is None:
             config = {}
         if waypoints is None:
-            waypoints = {}
+            waypoints = []
         print(tiles)
         print(waypoints)
 
         if thread and self.myRouter and not self.myRouter.is_complete:
             print("Abord previous route...")
             self.myRouter.abort()
-            self.thread.join()
+            # A job of the pool ends in its worker
+            if self.thread:
+                self.thread.join()
             print("   ...OK")
-        if mode != self.mode:
-            self.mode = mode
-            self.stored_tiles = {}
-            self.router = Datastore(mode, cache_dir=str(Path.home().joinpath('.tilescache')))
-        coord_dict = CoordDict(self.router)
-        start_point = coord_dict.get(*start_loc)
-        end_point = coord_dict.get(*end_loc)
-        ways_points = [coord_dict.get(*wp) for wp in waypoints]
-        print("Ways_points")
-        print(ways_points)
-
-        self.myRouter = MyRouter(self.router, start_point, end_point, tiles, ways_points, config)
+        self.mode = mode
+        request = (mode, start_loc, end_loc, tiles, waypoints, config)
+
+        on_done = None
+        if self.cache is not None:
+            route = self.cache.get(route_key(*request, TILES_CACHE_DIR))
+            if route is not None:
+                print("Route found in cache")
+                self.myRouter = CachedRouter(Route.from_dict(route))
+                return self.myRouter, self.is_complete, self.route
+            on_done = partial(self._store_route, request)
+
+        if thread and self.pool is not None:
+            job = self.pool.submit(*request, self.compact_graph, on_done=on_done)
+            if job is None:
+                return None, "Too many routes being computed, retry later", []
+            self.myRouter = job
+            return self.myRouter, self.is_complete, self.route
+
+        self.myRouter = create_router(*request, self.compact_graph)
         if thread:
-            self.thread = threading.Thread(target=self.myRouter.run)
+            self.thread = threading.Thread(target=self._run, args=(self.myRouter, on_done))
             # Background thread will finish with the main program
             self.thread.setDaemon(True)
             # Start YourLedRoutine() in a separate thread
             self.thread.start()
 
         else:
-            self.myRouter.run()
+            self._run(self.myRouter, on_done)
 
         return self.myRouter, self.is_complete, self.route
 
+    @staticmethod
+    def _run(my_router, on_done):
+        my_router.run()
+        if on_done is not None:
+            on_done(my_router)
+
+    def _store_route(self, request, my_router):
+        """Store a found route in the cache, with the OSM data it was found on (some tiles may have been
+        downloaded by the search)"""
+        if my_router.error_code == ERR_NO and my_router.min_route:
+            self.cache.put(route_key(*request, TILES_CACHE_DIR), my_router.min_route.to_dict())
+
     @property
     def progress(self):
         return self.myRouter.progress
@@ -1,6 +1,7 @@
 import time
 from functools import wraps
 
+import numpy as np
 from numpy import math
 
 
@@ -15,6 +16,42 @@ def distance(n1, n2):
     return math.asin(math.sqrt(d)) * 12742
 
 
+def distance_array(n1, lats, lons):
+    """Calculate distances in km between a node and arrays of latitudes and longitudes"""
+    lat1, lon1 = math.radians(n1[0]), math.radians(n1[1])
+    lats = np.radians(lats)
+    d = np.sin((lats - lat1) * 0.5) ** 2 + math.cos(lat1) * np.cos(lats) \
+        * np.sin((np.radians(lons) - lon1) * 0.5) ** 2
+    return np.arcsin(np.sqrt(d)) * 12742
+
+
+def path_length(latlons):
+    """Calculate length in km of a path given by the list of its nodes (lat, lon)"""
+    if len(latlons) < 2:
+        return 0
+    lats, lons = np.radians(np.asarray(latlons, dtype=float)).T
+    d = np.sin(np.diff(lats) * 0.5) ** 2 + np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(lons) * 0.5) ** 2
+    return float((np.arcsin(np.sqrt(d)) * 12742).sum())
+
+
+def encode_polyline(latlons, precision=5):
+    """Encode a path given by the list of its nodes (lat, lon) as an encoded polyline string
+    (Google polyline algorithm, with precision decimals)"""
+    factor = 10 ** precision
+    chars = []
+    prev_lat = prev_lon = 0
+    for lat, lon in latlons:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return ''.join(chars)
+
+
 # Print iterations progress
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', print_end="\r"):
     """